@@ -9,6 +9,8 @@ import pickle
 import statsmodels.api as sm
 import statsmodels.formula.api as smf
 import scipy
+from model_comparison import read_log_likelihoods, compare_elpd, subject_elpd
+from group_store import read_group
 
 
 # Suppress runtimewarning due to pandas bug
@@ -35,13 +37,16 @@ memory_fit_dict = pickle.load(open('../../Analysis/Analysis_Output/memory_parame
 perseverance_fit_dict = pickle.load(open('../../Analysis/Analysis_Output/perseverance_parameter_fits.pkl', 'rb'))
 permem_fit_dict = pickle.load(open('../../Analysis/Analysis_Output/permem_parameter_fits.pkl', 'rb'))
 
-gtrain_df = pd.read_pickle('../../Analysis/Analysis_Output/gtrain_df.pkl')
-gtrain_learn_df = pd.read_pickle('../../Analysis/Analysis_Output/gtrain_learn_df.pkl')
-gtest_learn_df = pd.read_pickle('../../Analysis/Analysis_Output/gtest_learn_df.pkl')
-gtest_conform_df = pd.read_pickle('../../Analysis/Analysis_Output/gtest_conform_df.pkl')
-gtest_df = pd.read_pickle('../../Analysis/Analysis_Output/gtest_df.pkl')
-gtrain_learn_df.id = gtrain_learn_df.id.astype('str').apply(lambda x: x.zfill(3))
-gtest_learn_df.id = gtest_learn_df.id.astype('str').apply(lambda x: x.zfill(3))
+group_store = '../../Analysis/Analysis_Output/group_store'
+# the train phase is only used for the feedback regressions
+gtrain_df = read_group(group_store, 'train', columns = ['id', 'context', 'subj_ts', 'FB'])
+# only the test columns used below
+posterior_columns = [model + '_posterior' + postfix for postfix in ['', '_cross'] 
+                     for model in ['bias2', 'bias1', 'eoptimal', 'ignore', 'midline', 
+                                   'switch', 'memory', 'perseverance', 'permem']]
+gtest_df = read_group(group_store, 'test', 
+                      columns = ['id', 'context', 'subj_ts', 'switch', 'subj_switch', 'rep_resp', 
+                                 'stim_conform', 'correct', 'rt', 'trial_count'] + posterior_columns)
 
 
 # *********************************************
@@ -116,6 +121,18 @@ param_cost_df = np.log(df.groupby('id').count()).iloc[:,0:len(summary.columns)]*
 param_cost_df.columns = summary.columns
 BIC_summary = -2*summary + param_cost_df
 
+# cross-validated comparison on the held-out per-trial log likelihoods
+# written by Individual_Analysis
+loglik_file = '../../Analysis/Analysis_Output/trial_loglik_cross'
+if os.path.exists(loglik_file + '.npy'):
+    cross_logliks, loglik_index = read_log_likelihoods(loglik_file)
+    elpd_summary = compare_elpd(cross_logliks, loglik_index)
+    subj_elpd = subject_elpd(cross_logliks, loglik_index)
+    if print_diagnoistic:
+        print(elpd_summary)
+        # number of subjects each model predicts best on held-out trials
+        print(subj_elpd.idxmax(1).value_counts().reindex(subj_elpd.columns, fill_value = 0))
+
 #extract column of best model
 min_col = BIC_summary.idxmin(1)
 best_models = min_col.map(lambda x: x[:x.find('_')])
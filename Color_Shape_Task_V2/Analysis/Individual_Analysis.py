@@ -5,12 +5,17 @@ Created on Mon Apr 27 11:16:08 2015
 """
 import numpy as np
 from Load_Data import load_data, preproc_data
-from helper_classes import BiasPredModel, SwitchModel, MemoryModel
-from helper_functions import fit_bias2_model, fit_bias1_model, fit_static_model, \
-    fit_switch_model, fit_midline_model, fit_memory_model, calc_posterior, gen_bias_TS_posteriors, \
-    gen_memory_TS_posteriors
-from os.path import join
-import pickle, glob, re
+from helper_classes import BiasPredModel, MemoryModel
+from helper_functions import fit_bias_family, \
+    fit_switch_model, fit_midline_model, fit_memory_model, gen_bias_TS_posteriors, \
+    gen_memory_TS_posteriors, run_fit_tasks, iter_fit_tasks, get_cv_splits, fit_and_count
+from observers import optimal_observer, midline_observer, switch_observer
+from group_store import write_subject, write_subset, read_group, read_subset, \
+    remove_subject, clear_store, read_manifest, update_manifest, subject_ids
+from fit_cache import FitCache
+from model_comparison import subject_log_likelihoods, write_log_likelihoods, \
+    read_log_likelihood_dict
+import argparse, pickle, glob, re, hashlib, os, time, contextlib, collections, itertools
 import pandas as pd
 from scipy.stats import norm, beta
 import warnings
@@ -23,65 +28,153 @@ warnings.simplefilter(action = "ignore", category = RuntimeWarning)
 # ********************************************
 def get_data(filey):
     file_name = re.match(r'.*/RawData.(.*).yaml', filey).group(1)
-    try:
-        info = pickle.load(open('../Data/' + file_name + '.pkl', 'rb'))
-        taskinfo, dfa = [info.get(k) for k in ['taskinfo', 'dfa']]
-    except IOError:
-        taskinfo, df, dfa = load_data(filey, file_name)
-        info = {'taskinfo': taskinfo, 'dfa': dfa}
-        pickle.dump(info, open('../Data/' + file_name + '.pkl','wb'), protocol = 2)
+    # the parsed raw data is kept in a binary sidecar in ../Data
+    taskinfo, df, dfa = load_data(filey, file_name, cache_dir = '../Data')
     return taskinfo,  dfa
 
-def get_model_dicts(filey):
+def add_time(stage_times, stage, start):
+    """
+    Add the time since start to stage_times[stage]
+    :return: the current time, to start the next stage from
+    """
+    now = time.time()
+    stage_times[stage] = stage_times.get(stage, 0) + now - start
+    return now
+
+@contextlib.contextmanager
+def timed(stage, stage_times):
+    """
+    Add the time spent in the with block to stage_times[stage]
+    """
+    start = time.time()
     try:
-        model_dicts = pickle.load(open(filey,'r'))
-    except IOError:
-        model_dicts = {}
-        model_names = ['bias2','bias1','eoptimal','ignore','midline','switch',
-                       'memory','perseverance','permem']
-        # set up dictionaries to hold fitted parameters for each subject
-        fitting_functions = [fit_bias2_model, fit_bias1_model, 
-                             fit_static_model, fit_static_model, 
-                             fit_midline_model, fit_switch_model, 
-                             fit_memory_model, fit_memory_model, 
-                             fit_memory_model]
-        for name, fun in zip(model_names,fitting_functions):
-            model = {'fitting_fun': fun}
-            try:
-                model['fit_dict'] = pickle.load(open(join('Analysis_Output', name+'_parameter_fits.pkl'), 'rb'))
-            except:
-                model['fit_dict'] = {}
-            model_dicts[name] = model    
+        yield
+    finally:
+        add_time(stage_times, stage, start)
+
+def data_hash(files, *settings):
+    """
+    Hash of the contents of a subject's raw data files and the settings its
+    outputs depend on, to tell which subjects are new or changed since the
+    group store was written
+    """
+    h = hashlib.sha1()
+    for filey in files:
+        with open(filey, 'rb') as f:
+            h.update(hashlib.sha1(f.read()).digest())
+    h.update(repr(settings).encode())
+    return h.hexdigest()
+
+def dump_pickle(obj, filename):
+    """
+    Pickle obj to a temporary file and move it into place, so an interrupted
+    run leaves the previous file rather than a partial one
+    """
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(obj, f, protocol = 2)
+    os.replace(tmp_file, filename)
+
+def get_model_dicts():
+    model_dicts = {}
+    model_names = ['bias2','bias1','eoptimal','ignore','midline','switch',
+                   'memory','perseverance','permem']
+    # set up dictionaries to hold fitted parameters for each subject. Fits
+    # are filled in from the fit cache or by fit_test_models. The bias models
+    # are nested and fit together
+    fitting_functions = [fit_bias_family, fit_bias_family, 
+                         fit_bias_family, fit_bias_family, 
+                         fit_midline_model, fit_switch_model, 
+                         fit_memory_model, fit_memory_model, 
+                         fit_memory_model]
+    for name, fun in zip(model_names,fitting_functions):
+        model_dicts[name] = {'fitting_fun': fun, 'fit_dict': {}, 'nfev': {}, 
+                             'cache_key': {}}
     return model_dicts
+
+def store_fit(model_dicts, name, fit_key, fit, nfev = None, cache_key = None):
+    """
+    Store a fit (and its number of objective evaluations) in the model's 
+    fit_dict, and the fit cache key it is stored under in the model's 
+    cache_key dict. Fits made by fit_bias_family hold every bias model's fit
+    """
+    if model_dicts[name]['fitting_fun'] is fit_bias_family:
+        fits, nfevs = fit, nfev
+    else:
+        fits, nfevs = {name: fit}, {name: nfev}
+    for model_name, model_fit in fits.items():
+        model_dicts[model_name]['fit_dict'][fit_key] = model_fit
+        if nfev is not None:
+            model_dicts[model_name]['nfev'][fit_key] = nfevs[model_name]
+        if cache_key is not None:
+            model_dicts[model_name]['cache_key'][fit_key] = cache_key
     
-def fit_test_models(ts_distributions, rp, action_eps, test, model_dicts, verbose = True):
-    df_midpoint = int(len(test)/2)
+def get_fit_tasks(subj_name, ts_distributions, rp, action_eps, test, model_dicts, 
+                  fit_cache, splits = None, n_folds = 2, n_restarts = 0, verbose = True):
+    """
+    Fill in one subject's fits from the fit cache and list the ones that are
+    missing. Each model is fit to the full test run and to the training set of
+    each of n_folds contiguous-block cross-validation folds (see get_cv_splits).
+    Fold fits start from the full-run fit when it is already in the fit_dict.
+    The bias models are fit together in one task, listed under bias2
+    :splits: names of the splits to fit, default all of them
+    :return: list of tasks for run_fit_tasks, keyed by 
+        (model name, fit_dict key, fit cache key)
+    """
+    split_data = get_cv_splits(test, n_folds)[0]
+    if splits is None:
+        splits = list(split_data.keys())
+    tasks = []
     for model_type in ['TS']:
         for name, model in model_dicts.items():
-            if verbose:
-                print('\nFitting %s Model\n' % name)
             fit_dict = model['fit_dict']
             fun = model['fitting_fun']
             args = {}
-            if name in ['bias2', 'bias1']:
-                args = {'action_eps': action_eps, 'model_type': model_type}
-            elif name == 'eoptimal':
+            if fun is fit_bias_family and name != 'bias2':
+                continue
+            elif name == 'bias2':
                 args = {'rp': rp, 'action_eps': action_eps, 'model_type': model_type}
-            elif name == 'ignore':
-                args = {'rp': .5, 'action_eps': action_eps, 'model_type': model_type}
             elif name == 'memory':
                 args = {'perseverance': 0}
             elif name == 'perseverance':
                 args = {'k': 0}
-            if subj_name + '_' + model_type + '_first' not in fit_dict.keys():
+            args.update({'n_restarts': n_restarts, 'rng': 0})
+            for p in splits:
                 if name in ['midline', 'switch']:
-                    fit_dict[subj_name + '_' + model_type + '_fullRun'] = fun(test, verbose = verbose)
-                    fit_dict[subj_name + '_' + model_type + '_first'] = fun(test.iloc[0:df_midpoint], verbose = verbose)
-                    fit_dict[subj_name + '_' + model_type + '_second'] = fun(test.iloc[0:df_midpoint], verbose = verbose)
+                    fun_args = (split_data[p],)
                 else:
-                    fit_dict[subj_name + '_' + model_type + '_fullRun'] = fun(ts_distributions, test, verbose = verbose, **args)
-                    fit_dict[subj_name + '_' + model_type + '_first'] = fun(ts_distributions, test.iloc[0:df_midpoint], verbose = verbose, **args)
-                    fit_dict[subj_name + '_' + model_type + '_second'] = fun(ts_distributions, test.iloc[0:df_midpoint], verbose = verbose, **args)
+                    fun_args = (ts_distributions, split_data[p])
+                fit_key = subj_name + '_' + model_type + p
+                fit_args = dict(args)
+                full_run_key = subj_name + '_' + model_type + '_fullRun'
+                if p != '_fullRun' and full_run_key in fit_dict:
+                    if fun is fit_bias_family:
+                        fit_args['init'] = {m: d['fit_dict'][full_run_key] 
+                                            for m, d in model_dicts.items() 
+                                            if d['fitting_fun'] is fit_bias_family}
+                    else:
+                        fit_args['init'] = fit_dict[full_run_key]
+                cache_key = fit_cache.key(name, fun, fun_args, fit_args)
+                fit = fit_cache.get(cache_key)
+                if fit is not None:
+                    store_fit(model_dicts, name, fit_key, fit, cache_key = cache_key)
+                else:
+                    tasks.append(((name, fit_key, cache_key), fit_and_count, 
+                                  (fun,) + fun_args, dict(fit_args, verbose = verbose)))
+    return tasks
+
+def fit_test_models(tasks, model_dicts, fit_cache, jobs = 1):
+    """
+    Run fit tasks from get_fit_tasks, in parallel if jobs > 1, and merge the
+    results into each model's fit_dict and the fit cache. The number of
+    objective evaluations each fit used is kept in the model's nfev dict. 
+    Failed fits are reported and left out
+    """
+    for (name, fit_key, cache_key), result, error in run_fit_tasks(tasks, jobs):
+        if error is None:
+            fit, nfev = result
+            store_fit(model_dicts, name, fit_key, fit, nfev, cache_key)
+            fit_cache.put(cache_key, fit)
 
 def get_ts_distributions(dist, states):
     if dist == "norm":
@@ -90,160 +183,292 @@ def get_ts_distributions(dist, states):
         ts_dis = [beta(**states[s]['dist_args']) for s in [0,1]]
     return ts_dis
 
+def load_subject(train_file, test_file):
+    """
+    Load and preprocess one subject's train and test files. Run by the loading
+    pool, so it returns the time it spent in each stage for the summary
+    :return: (subj_name, taskinfo, ts_dis, train_ts_dis, train_recursive_p, 
+        action_eps, train_dfa, test_dfa) and dict of stage -> seconds
+    """
+    stage_times = {}
+    subj_name = re.match(r'.*/RawData.(\w*)_Prob*', test_file).group(1)
+    with timed('load', stage_times):
+        taskinfo, train_dfa = get_data(train_file)
+        taskinfo, test_dfa = get_data(test_file)
+    with timed('preproc', stage_times):
+        dist = taskinfo['task_distribution']
+        ts_dis = get_ts_distributions(dist, taskinfo['states'])
+        train_ts_dis,train_recursive_p,action_eps = preproc_data(train_dfa,
+                                                                 test_dfa,
+                                                                 taskinfo,
+                                                                 dist)        
+    return (subj_name, taskinfo, ts_dis, train_ts_dis, train_recursive_p, action_eps, 
+            train_dfa, test_dfa), stage_times
+
+def n_folds_arg(value):
+    """
+    argparse type for --folds. Cross-validation needs at least 2 folds
+    """
+    n_folds = int(value)
+    if n_folds < 2:
+        raise argparse.ArgumentTypeError('needs at least 2 folds, got %s' % value)
+    return n_folds
+
 # *********************************************
 # Set up defaults
 # *********************************************
 plot = False
 save = True
-model_dicts = get_model_dicts('Analysis_Output/model_fits.pkl')
+parser = argparse.ArgumentParser()
+parser.add_argument('--jobs', type = int, default = 1, 
+                    help = 'number of processes to run model fits in')
+parser.add_argument('--restarts', type = int, default = 0, 
+                    help = 'maximum number of random restarts for each model fit')
+parser.add_argument('--folds', type = n_folds_arg, default = 2, 
+                    help = 'number of contiguous blocks the test run is split into for cross-validation')
+parser.add_argument('--incremental', action = 'store_true',
+                    help = 'only process subjects whose raw data files are new or changed since the last run')
+args = parser.parse_known_args()[0]
+jobs = args.jobs
+n_restarts = args.restarts
+n_folds = args.folds
+incremental = args.incremental
+cv_splits = ['_fold%s' % i for i in range(n_folds)]
+model_dicts = get_model_dicts()
+fit_cache = FitCache('Analysis_Output/fit_cache')
 
 # *********************************************
 # Load Data
 # ********************************************
+group_store = 'Analysis_Output/group_store'
 if save is False:
-    gtrain_learn_df = pd.read_pickle('Analysis_Output/gtrain_learn_df.pkl')
-    gtest_learn_df = pd.read_pickle('Analysis_Output/gtest_learn_df.pkl')
-    gtest_conform_df = pd.read_pickle('Analysis_Output/gtest_conform_df.pkl')
-    gtest_df = pd.read_pickle('Analysis_Output/gtest_df.pkl')
-    gtrain_learn_df.id = gtrain_learn_df.id.astype('str').apply(lambda x: x.zfill(3))
-    gtest_learn_df.id = gtest_learn_df.id.astype('str').apply(lambda x: x.zfill(3))
+    gtrain_learn_df = read_group(group_store, 'train', subset = 'learn')
+    gtest_df = read_group(group_store, 'test')
+    gtest_conform_df = gtest_df[gtest_df.id.isin(read_subset(group_store, 'conform'))]
+    gtest_learn_df = gtest_df[gtest_df.id.isin(read_subset(group_store, 'learn'))]
 
 else:
     group_behavior = {}
-    gtrain_df = pd.DataFrame()
-    gtest_df = pd.DataFrame()
-    gtaskinfo = []
+    gtaskinfo = {}
     data_files = sorted(glob.glob('../Data/RawData/*yaml'))
     train_files = [f for f in data_files if 'test' not in f]
     test_files = [f for f in data_files if 'test' in f]
-
+    # seconds spent in each stage. Loading and preprocessing are summed over
+    # the workers and overlap with fitting, so can add up to more than their 
+    # wall time. 'load + preproc (wait)' is the time spent waiting on them
+    stage_times = collections.OrderedDict()
+    # per-trial log likelihoods under the full-run fits and held out (scored
+    # with the fits that left each trial's block out), keyed by (subject, model)
+    trial_logliks = {}
+    cross_logliks = {}
+    fit_subjects = []
+    
+    # subjects whose raw data and settings match the manifest are already in
+    # the group store. Only the others are loaded, fit and written
+    data_hashes = {}
     for train_file, test_file in zip(train_files, test_files):
         subj_name = re.match(r'.*/RawData.(\w*)_Prob*', test_file).group(1)
-        print(subj_name)
-    
-        # load pickled data. If pickled data doesn't exist, pickle the data
-        taskinfo, train_dfa = get_data(train_file)
-        taskinfo, test_dfa = get_data(test_file)
+        data_hashes[subj_name] = data_hash([train_file, test_file], n_folds, n_restarts)
+    if incremental:
+        manifest = read_manifest(group_store)
+    else:
+        clear_store(group_store)
+        manifest = {}
+    kept_subjects = [subj_name for subj_name in data_hashes 
+                     if manifest.get(subj_name) == data_hashes[subj_name]]
+    if kept_subjects:
+        # carry over the unchanged subjects' fits, log likelihoods and taskinfo.
+        # Subjects missing from any of them are fit again
+        try:
+            old_model_dicts = pickle.load(open('Analysis_Output/model_fits.pkl', 'rb'))
+            old_trial_logliks = read_log_likelihood_dict('Analysis_Output/trial_loglik', 
+                                                         kept_subjects)
+            old_cross_logliks = read_log_likelihood_dict('Analysis_Output/trial_loglik_cross', 
+                                                         kept_subjects)
+            old_taskinfo = pd.read_pickle('Analysis_Output_gtaskinfo.pkl')
+        except (IOError, EOFError, pickle.UnpicklingError) as e:
+            print('Fitting all subjects again, the last run\'s outputs can\'t be read: %s' % e)
+            old_model_dicts, old_trial_logliks, old_cross_logliks = {}, {}, {}
+            old_taskinfo = pd.DataFrame()
+        def is_saved(subj_name):
+            fit_keys = [subj_name + '_TS' + p for p in cv_splits + ['_fullRun']]
+            return (subj_name in old_taskinfo.index and
+                    all(key in old_model_dicts.get(name, {}).get('fit_dict', {}) 
+                        for name in model_dicts for key in fit_keys) and
+                    all((subj_name, name) in logliks for name in model_dicts
+                        for logliks in [old_trial_logliks, old_cross_logliks]))
+        kept_subjects = [subj_name for subj_name in kept_subjects if is_saved(subj_name)]
+    stored_subjects = set(manifest).union(*[subject_ids(group_store, phase) 
+                                            for phase in ['train', 'test']])
+    for subj_name in stored_subjects:
+        if subj_name not in kept_subjects:
+            remove_subject(group_store, subj_name)
+    if kept_subjects:
+        print('%s subjects are unchanged since the last run' % len(kept_subjects))
+        kept_keys = set(subj_name + '_TS' + p for subj_name in kept_subjects
+                        for p in cv_splits + ['_fullRun'])
+        for name, model in model_dicts.items():
+            for field in ['fit_dict', 'nfev', 'cache_key']:
+                model[field].update({key: value for key, value in 
+                                     old_model_dicts[name].get(field, {}).items() 
+                                     if key in kept_keys})
+        trial_logliks = {key: ll for key, ll in old_trial_logliks.items() 
+                         if key[0] in kept_subjects}
+        cross_logliks = {key: ll for key, ll in old_cross_logliks.items() 
+                         if key[0] in kept_subjects}
+        gtaskinfo.update({subj_name: old_taskinfo.loc[subj_name].to_dict() 
+                          for subj_name in kept_subjects})
+        fit_subjects = list(kept_subjects)
 
-        # *********************************************
-        # Preliminary Setup
-        # *********************************************
-        dist = taskinfo['task_distribution']
-        ts_dis = get_ts_distributions(dist, taskinfo['states'])
-        train_ts_dis,train_recursive_p,action_eps = preproc_data(train_dfa,
-                                                                 test_dfa,
-                                                                 taskinfo,
-                                                                 dist)        
+    # *********************************************
+    # Load and preprocess
+    # *********************************************
+    # subjects come out in file order. At most 2*jobs subjects are loading or
+    # waiting on an earlier one at a time
+    load_tasks = [(re.match(r'.*/RawData.(\w*)_Prob*', test_file).group(1), load_subject, 
+                   (train_file, test_file), {}) 
+                  for train_file, test_file in zip(train_files, test_files)]
+    load_tasks = [task for task in load_tasks if task[0] not in kept_subjects]
+    def load_subjects():
+        for subj_name, result, error in iter_fit_tasks(load_tasks, jobs, verbose = False,
+                                                       max_pending = 2*jobs):
+            if error is not None:
+                print('Skipping %s, loading failed:\n%s' % (subj_name, error))
+                continue
+            print(subj_name)
+            subject, subj_times = result
+            for stage, seconds in subj_times.items():
+                stage_times[stage] = stage_times.get(stage, 0) + seconds
+            yield subject
+    
+    # subjects are fit, scored and written a window of jobs subjects at a time
+    # while the next ones load, and their data dropped before the next window
+    loaded_subjects = load_subjects()
+    while True:
+        with timed('load + preproc (wait)', stage_times):
+            window = list(itertools.islice(loaded_subjects, max(jobs, 1)))
+        if not window:
+            break
         
         # *********************************************
         # Model fitting
         # *********************************************
-        fit_test_models(train_ts_dis, train_recursive_p, action_eps, test_dfa, model_dicts)
+        # fit the full runs first so the fold fits can start from them
+        with timed('fit', stage_times):
+            for splits in [['_fullRun'], cv_splits]:
+                fit_tasks = []
+                for subj_name, _, _, train_ts_dis, train_recursive_p, action_eps, _, test_dfa in window:
+                    fit_tasks += get_fit_tasks(subj_name, train_ts_dis, train_recursive_p, 
+                                               action_eps, test_dfa, model_dicts, fit_cache,
+                                               splits, n_folds, n_restarts, verbose = jobs == 1)
+                fit_test_models(fit_tasks, model_dicts, fit_cache, jobs)
+    
+        for subj_name, taskinfo, ts_dis, train_ts_dis, _, _, train_dfa, test_dfa in window:
+            fit_keys = [subj_name + '_TS' + p for p in cv_splits + ['_fullRun']]
+            if not all(key in model['fit_dict'] for model in model_dicts.values() for key in fit_keys):
+                print('Skipping %s, some model fits failed' % subj_name)
+                continue
+            start = time.time()
         
-        # *********************************************
-        # Set up observers
-        # *********************************************
+            # *********************************************
+            # Set up observers
+            # *********************************************
         
-        # **************TRAIN*********************
-        # This observer know the exact statistics of the task, always chooses correctly
-        # given that it chooses the correct task-set, and perfectly learns from feedback.
-        # This means that it sets the prior probability for each ts to the transition probabilities
-        # of the correct task-set on each trial (which a subject 'could' do due to the
-        # deterministic feedback). Basically, after receiving FB, the ideal observer
-        # knows exactly what task it is in and should act accordingly.
-        observer_prior = [.5,.5]
-        posteriors = []
-        for i,trial in train_dfa.iterrows():
-            c = trial.context
-            posteriors.append(calc_posterior(c,observer_prior,ts_dis))
-            ts = trial.ts
-            observer_prior = np.round([.9*(1-ts)+.1*ts,.9*ts+.1*(1-ts)],2)
-        train_dfa.loc[:,'optimal_posterior'] = posteriors
+            # **************TRAIN*********************
+            # This observer know the exact statistics of the task, always chooses correctly
+            # given that it chooses the correct task-set, and perfectly learns from feedback.
+            # This means that it sets the prior probability for each ts to the transition probabilities
+            # of the correct task-set on each trial (which a subject 'could' do due to the
+            # deterministic feedback). Basically, after receiving FB, the ideal observer
+            # knows exactly what task it is in and should act accordingly.
+            train_dfa.loc[:,'optimal_posterior'] = optimal_observer(train_dfa.context.values,
+                                                                   train_dfa.ts.values, ts_dis)
 
         
-        # **************TEST*********************
-        model_type = '_TS'
-        for p in ['_first','_second','_fullRun']:
-            bias_models = []
-            memory_models = []
-            # Bias2 observer for test    
-            for model in ['bias2', 'bias1', 'eoptimal', 'ignore']:
-                params = model_dicts[model]['fit_dict'][subj_name + model_type + p]
-                bias_models.append(BiasPredModel(train_ts_dis, [.5,.5], **params)) 
+            # **************TEST*********************
+            model_type = '_TS'
+            held_out = get_cv_splits(test_dfa, n_folds)[1]
+            # fold of each trial's held-out block
+            trial_fold = np.zeros(len(test_dfa), dtype = int)
+            for i, p in enumerate(cv_splits):
+                trial_fold[held_out[p]] = i
+            for p in cv_splits + ['_fullRun']:
+                bias_models = []
+                memory_models = []
+                # Bias2 observer for test    
+                for model in ['bias2', 'bias1', 'eoptimal', 'ignore']:
+                    params = model_dicts[model]['fit_dict'][subj_name + model_type + p]
+                    bias_models.append(BiasPredModel(train_ts_dis, [.5,.5], **params)) 
                 
-            for model in ['memory','perseverance','permem']:
-                params = model_dicts[model]['fit_dict'][subj_name + model_type + p]
-                memory_models.append(MemoryModel(train_ts_dis, **params)) 
+                for model in ['memory','perseverance','permem']:
+                    params = model_dicts[model]['fit_dict'][subj_name + model_type + p]
+                    memory_models.append(MemoryModel(train_ts_dis, **params)) 
                 
-            if p != '_fullRun':
-                postfix = p
-            else:
-                postfix = ''
+                if p != '_fullRun':
+                    postfix = p
+                else:
+                    postfix = ''
                 
-            # Fit observer for test        
-            gen_bias_TS_posteriors(bias_models, test_dfa, ['bias2', 'bias1', 'eoptimal', 'ignore'], postfix = postfix)
-            gen_memory_TS_posteriors(memory_models, test_dfa, ['memory', 'perseverance', 'permem'], postfix = postfix)
+                # Fit observer for test        
+                gen_bias_TS_posteriors(bias_models, test_dfa, ['bias2', 'bias1', 'eoptimal', 'ignore'], postfix = postfix)
+                gen_memory_TS_posteriors(memory_models, test_dfa, ['memory', 'perseverance', 'permem'], postfix = postfix)
         
-        for model in ['bias2', 'bias1', 'eoptimal', 'ignore', 'memory', 'perseverance','permem']:
-            df_midpoint = int(len(test_dfa)/2)
-            cross_posteriors = pd.concat([test_dfa[:df_midpoint][model + '_posterior_second'],test_dfa[df_midpoint:][model + '_posterior_first']])
-            test_dfa[model + '_posterior_cross'] = cross_posteriors
-            test_dfa.drop([model + '_posterior_first', model + '_posterior_second'], inplace = True, axis = 1)
+            # held-out posteriors: each block's trials from the fold that left it out
+            for model in ['bias2', 'bias1', 'eoptimal', 'ignore', 'memory', 'perseverance','permem']:
+                cross_posteriors = pd.concat([test_dfa[held_out[p]][model + '_posterior' + p] for p in cv_splits])
+                test_dfa[model + '_posterior_cross'] = cross_posteriors
+                test_dfa.drop([model + '_posterior' + p for p in cv_splits], inplace = True, axis = 1)
         
-        midline_eps = []
-        switch_models = []
-        for p in ['_first','_second','_fullRun']:
-            midline_eps.append(model_dicts['midline']['fit_dict'][subj_name + model_type + p]['eps'])
-            switch_params = model_dicts['switch']['fit_dict'][subj_name + model_type + p]          
-            switch_models.append(SwitchModel(**switch_params))
+            # parameters of each fold, then the full run, one column per parameter
+            midline_params = pd.DataFrame([model_dicts['midline']['fit_dict'][subj_name + model_type + p]
+                                           for p in cv_splits + ['_fullRun']])
+            switch_params = pd.DataFrame([model_dicts['switch']['fit_dict'][subj_name + model_type + p]
+                                          for p in cv_splits + ['_fullRun']])
+            full_run = lambda params: params.iloc[-1].to_dict()
+            # each trial gets the parameters of the fold that held it out
+            cross = lambda params: {name: values.values[trial_fold] for name, values in params.items()}
                                   
-        # midline observer for test  
-        posteriors = []
-        posteriors_cross = []
-        for i,trial in test_dfa.iterrows():
-            c = max(0,np.sign(trial.context))
-            posteriors.append(abs(c - midline_eps[2]))
-            if i<df_midpoint:
-                posteriors_cross.append(abs(c-midline_eps[1]))
-            else:
-                posteriors_cross.append(abs(c-midline_eps[0]))
-        posteriors = np.array(posteriors)
-        posteriors_cross = np.array(posteriors_cross)        
-        test_dfa['midline_posterior'] = posteriors
-        test_dfa['midline_posterior_cross'] = posteriors_cross
-    
-        # Switch observer for test  
-        posteriors = []
-        posteriors_cross = []
-        for i,trial in test_dfa.iterrows():
-            if i == 0:
-                 last_choice = -1 
-            else:
-                last_choice = test_dfa.subj_ts[i-1]
-            trial_choice = trial.subj_ts
-            conf = switch_models[2].calc_TS_prob(last_choice)
-            if i<df_midpoint:
-                conf_cross = switch_models[1].calc_TS_prob(last_choice)
-            else:
-                conf_cross = switch_models[0].calc_TS_prob(last_choice)
-            posteriors.append(conf[trial_choice])  
-            posteriors_cross.append(conf_cross[trial_choice])
-        posteriors = np.array(posteriors)
-        posteriors_cross = np.array(posteriors_cross) 
-        test_dfa['switch_posterior'] = posteriors
-        test_dfa['switch_posterior_cross'] = posteriors_cross
+            # midline and switch observers for test  
+            contexts = test_dfa.context.values
+            choices = test_dfa.subj_ts.values
+            test_dfa['midline_posterior'] = midline_observer(contexts, **full_run(midline_params))
+            test_dfa['midline_posterior_cross'] = midline_observer(contexts, **cross(midline_params))
+            test_dfa['switch_posterior'] = switch_observer(choices, **full_run(switch_params))
+            test_dfa['switch_posterior_cross'] = switch_observer(choices, **cross(switch_params))
         
-        # ********************************************************************
-        # Clean up and add df to group df
-        # ********************************************************************
-        train_dfa['id'] = subj_name
-        test_dfa['id'] = subj_name
-        gtrain_df = pd.concat([gtrain_df,train_dfa])
-        gtest_df = pd.concat([gtest_df,test_dfa])   
-        gtaskinfo.append(taskinfo)
+            # per-trial log likelihoods
+            start = add_time(stage_times, 'posteriors', start)
+            fit_key = lambda p: subj_name + model_type + p
+            cross_splits = [(p, held_out[p]) for p in cv_splits]
+            for logliks, splits in [(trial_logliks, None), (cross_logliks, cross_splits)]:
+                subj_logliks = subject_log_likelihoods(model_dicts.keys(), fit_key, model_dicts, 
+                                                       test_dfa, train_ts_dis, splits)
+                logliks.update({(subj_name, name): ll for name, ll in subj_logliks.items()})
+            fit_subjects.append(subj_name)
+        
+            # ********************************************************************
+            # Clean up and add the subject to the group store
+            # ********************************************************************
+            start = add_time(stage_times, 'log likelihoods', start)
+            write_subject(group_store, 'train', subj_name, train_dfa)
+            write_subject(group_store, 'test', subj_name, test_dfa)
+            gtaskinfo[subj_name] = taskinfo
+            add_time(stage_times, 'write', start)
     
+    # drop fits made by older versions of the fitting code, and fits to
+    # data that no subject has any more
+    with timed('fit', stage_times):
+        fit_cache.evict(keep = [key for model in model_dicts.values() 
+                                for key in model['cache_key'].values()])
      
-    gtaskinfo = pd.DataFrame(gtaskinfo)
+    start = time.time()
+    # subjects in the same order as their data files
+    fit_subjects = [subj_name for subj_name in data_hashes if subj_name in fit_subjects]
+    gtaskinfo = pd.DataFrame.from_dict(gtaskinfo, orient = 'index').reindex(fit_subjects)
+    write_log_likelihoods('Analysis_Output/trial_loglik', trial_logliks, fit_subjects, 
+                          list(model_dicts.keys()))
+    write_log_likelihoods('Analysis_Output/trial_loglik_cross', cross_logliks, fit_subjects, 
+                          list(model_dicts.keys()))
 
 
                 
@@ -253,35 +478,36 @@ else:
     
     #arbitrary behavioral exclusion
     # Exclude subjects where stim_confom is below some threshold 
-    select_ids = gtest_df.groupby('id').mean().stim_conform>.75
+    # (the subsets are stored as lists of ids, not copies of the rows)
+    gtest_df = read_group(group_store, 'test', columns = ['id', 'stim_conform', 'correct'])
+    select_ids = gtest_df.groupby('id').stim_conform.mean()>.75
     select_ids = select_ids[select_ids]
-    select_rows = [i in select_ids for i in gtrain_df.id]
-    gtrain_conform_df = gtrain_df[select_rows]
-    select_rows = [i in select_ids for i in gtest_df.id]
-    gtest_conform_df = gtest_df[select_rows]
+    gtest_conform_df = gtest_df[gtest_df.id.isin(select_ids.index)]
     ids = select_ids.index
     
     # separate learner group
-    select_ids = gtest_conform_df.groupby('id').mean().correct > .5
+    select_ids = gtest_conform_df.groupby('id').correct.mean() > .5
     select_ids = select_ids[select_ids]
-    select_rows = [i in select_ids for i in gtrain_conform_df.id]
-    gtrain_learn_df = gtrain_conform_df[select_rows]
-    select_rows = [i in select_ids for i in gtest_conform_df.id]
-    gtest_learn_df = gtest_conform_df[select_rows]
     learn_ids = select_ids.index
 
 # *********************************************
 # Save
 # ********************************************* 
 
-    pickle.dump(model_dicts,open('Analysis_Output/model_fits.pkl','wb'), protocol=2)
-    pickle.dump(gtest_learn_df, open('Analysis_Output/gtest_learn_df.pkl','wb'), protocol=2)
-    pickle.dump(gtest_conform_df, open('Analysis_Output/gtest_conform_df.pkl','wb'), protocol=2)
-    pickle.dump(gtest_df, open('Analysis_Output/gtest_df.pkl','wb'), protocol=2)
-    pickle.dump(gtrain_learn_df, open('Analysis_Output/gtrain_learn_df.pkl','wb'), protocol=2)
-    pickle.dump(gtrain_conform_df, open('Analysis_Output/gtrain_conform_df.pkl','wb'), protocol=2)
-    pickle.dump(gtrain_df, open('Analysis_Output/gtrain_df.pkl','wb'), protocol=2)
-    pickle.dump(gtaskinfo, open('Analysis_Output_gtaskinfo.pkl','wb'), protocol=2)
+    dump_pickle(model_dicts, 'Analysis_Output/model_fits.pkl')
+    write_subset(group_store, 'conform', ids)
+    write_subset(group_store, 'learn', learn_ids)
+    dump_pickle(gtaskinfo, 'Analysis_Output_gtaskinfo.pkl')
+    # only now that their fits, log likelihoods and taskinfo are saved are the
+    # new subjects marked as done, so an interrupted run redoes them
+    for subj_name in fit_subjects:
+        if subj_name not in kept_subjects:
+            update_manifest(group_store, subj_name, data_hashes[subj_name])
+    add_time(stage_times, 'write', start)
+    
+    print('\nTime per stage (s):')
+    for stage, seconds in stage_times.items():
+        print('%-25s %8.2f' % (stage, seconds))
 
 
 
@@ -5,22 +5,159 @@ Created on Tue Dec  9 14:22:54 2014
 @author: admin
 """
 
-import yaml
+import yaml, json, os, hashlib
 import numpy as np
 import pandas as pd
 from scipy.stats import norm, beta
 
-def load_data(datafile, name):
+# libyaml's C loader when PyYAML was built with it
+class TaskLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
     """
-    Load a temporal structure task data file. Cleans up the raw data (returns
-    the first action/rt, removes trials without a response). Returns the global
-    taskinfo, the cleaned up data and a new dataset for analysis (with some
-    variables removed, and some created)
-    
-    Finally saves the data as csv files
+    Safe yaml loader that also reads the tuples yaml.dump writes as !!python/tuple,
+    the only python tag in the task's config and data files
+    """
+TaskLoader.add_constructor('tag:yaml.org,2002:python/tuple',
+                           lambda loader, node: tuple(loader.construct_sequence(node)))
+
+def yaml_load(stream):
+    """
+    Load yaml with TaskLoader. Other python tags raise a ConstructorError
+    rather than constructing arbitrary objects
+    """
+    return yaml.load(stream, Loader = TaskLoader)
+
+# *********************************************
+# Binary sidecar
+# *********************************************
+# A raw data file's cleaned up trials are saved in a directory of .npy files,
+# one per column, which are memory mapped on later loads. Columns of other
+# values (strings, dicts, None) are stored as codes into a list of their
+# distinct values, since they are mostly repeated. The distinct values and the
+# taskinfo go in sidecar.json along with the raw file's mtime, size and hash.
+# The sidecar is rebuilt when the raw file's hash changes
+
+def _to_json(obj):
+    """
+    Convert obj to json, keeping tuples and dicts with non-string keys
+    """
+    if isinstance(obj, tuple):
+        return {'__tuple__': [_to_json(x) for x in obj]}
+    elif isinstance(obj, list):
+        return [_to_json(x) for x in obj]
+    elif isinstance(obj, dict):
+        if all(isinstance(key, str) for key in obj) and '__tuple__' not in obj:
+            return {key: _to_json(value) for key, value in obj.items()}
+        return {'__items__': [[_to_json(key), _to_json(value)] for key, value in obj.items()]}
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+def _from_json(obj):
     """
-    f=open(datafile)
-    loaded_yaml = yaml.load(f)
+    json object_hook that undoes _to_json
+    """
+    if '__tuple__' in obj:
+        return tuple(obj['__tuple__'])
+    elif '__items__' in obj:
+        return {key: value for key, value in obj['__items__']}
+    return obj
+
+def _file_hash(filey):
+    with open(filey, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def _read_meta(sidecar):
+    try:
+        with open(os.path.join(sidecar, 'sidecar.json')) as f:
+            return json.load(f, object_hook = _from_json)
+    except (IOError, ValueError):
+        return None
+
+def _write_meta(sidecar, meta):
+    tmp_file = os.path.join(sidecar, 'sidecar.json.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(_to_json(meta), f)
+    os.replace(tmp_file, os.path.join(sidecar, 'sidecar.json'))
+
+def write_sidecar(sidecar, datafile, taskinfo, df):
+    """
+    Save a raw data file's taskinfo and cleaned up trials to the sidecar directory
+    """
+    os.makedirs(sidecar, exist_ok = True)
+    stat = os.stat(datafile)
+    meta = {'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': _file_hash(datafile),
+            'taskinfo': taskinfo, 'columns': []}
+    for i, col in enumerate(df.columns):
+        values = df[col].values
+        kind = 'codes'
+        distinct = None
+        if values.dtype.kind in 'biuf':
+            kind = 'array'
+        elif pd.api.types.infer_dtype(values, skipna = False) in ['integer', 'floating']:
+            # numbers in an object column, which is kept on load
+            values, kind = np.array(values.tolist()), 'array'
+        elif len(values) and all(isinstance(x, tuple) for x in values):
+            # e.g. stim: tuples of ints of the same length
+            tuples = np.array(values.tolist())
+            if tuples.ndim == 2 and tuples.dtype.kind in 'biuf':
+                values, kind = tuples, 'tuples'
+        if kind == 'codes':
+            keys = [json.dumps(_to_json(x), sort_keys = True) for x in values]
+            values = pd.factorize(np.array(keys, dtype = object))[0]
+            first = np.unique(values, return_index = True)[1]
+            distinct = [df[col].iloc[j] for j in first]
+        np.save(os.path.join(sidecar, '%s.npy' % i), values)
+        meta['columns'].append((col, kind, str(df[col].dtype), distinct))
+    _write_meta(sidecar, meta)
+
+def read_sidecar(sidecar, datafile):
+    """
+    Load taskinfo and the cleaned up trials from a sidecar directory, memory
+    mapping the arrays. The raw file's mtime and size are checked first, and
+    its hash only if they changed
+    :return: taskinfo and dataframe, or None if there is no sidecar or the raw
+        file has changed
+    """
+    meta = _read_meta(sidecar)
+    if meta is None:
+        return None
+    stat = os.stat(datafile)
+    if (meta['mtime'], meta['size']) != (stat.st_mtime, stat.st_size):
+        if meta['hash'] != _file_hash(datafile):
+            return None
+        # touched but unchanged
+        meta['mtime'], meta['size'] = stat.st_mtime, stat.st_size
+        _write_meta(sidecar, meta)
+    columns = {}
+    dtypes = {}
+    for i, (col, kind, dtype, distinct) in enumerate(meta['columns']):
+        values = np.load(os.path.join(sidecar, '%s.npy' % i), mmap_mode = 'r')
+        if kind == 'tuples':
+            values = list(map(tuple, values.tolist()))
+        elif kind == 'codes':
+            distinct_values = np.empty(len(distinct), dtype = object)
+            for j, value in enumerate(distinct):
+                distinct_values[j] = value
+            values = distinct_values[values]
+        if kind != 'tuples' and dtype != str(values.dtype):
+            dtypes[col] = dtype
+        columns[col] = values
+    return meta['taskinfo'], pd.DataFrame(columns).astype(dtypes)
+
+def read_raw_data(datafile, sidecar = None):
+    """
+    Load a temporal structure task data file and clean up the raw data (returns
+    the first action/rt, removes trials without a response)
+    :sidecar: directory of a binary sidecar to read the data from if it is up
+        to date, or to write it to otherwise. None always parses the yaml
+    :return: taskinfo and the cleaned up dataframe
+    """
+    if sidecar is not None:
+        loaded = read_sidecar(sidecar, datafile)
+        if loaded is not None:
+            return loaded
+    with open(datafile) as f:
+        loaded_yaml = yaml_load(f)
     data = loaded_yaml['taskdata']
     taskinfo = loaded_yaml['taskinfo']
     
@@ -37,6 +174,22 @@ def load_data(datafile, name):
     #Remove missed trials:
     df = df[df.rt != 999]
     df = df.reset_index(drop=True)
+    if sidecar is not None:
+        write_sidecar(sidecar, datafile, taskinfo, df)
+    return taskinfo, df
+
+def load_data(datafile, name, cache_dir = None):
+    """
+    Load a temporal structure task data file. Cleans up the raw data (returns
+    the first action/rt, removes trials without a response). Returns the global
+    taskinfo, the cleaned up data and a new dataset for analysis (with some
+    variables removed, and some created)
+    
+    :cache_dir: directory to keep the file's binary sidecar (name_sidecar) in,
+        see read_raw_data. None doesn't use a sidecar
+    """
+    sidecar = None if cache_dir is None else os.path.join(cache_dir, name + '_sidecar')
+    taskinfo, df = read_raw_data(datafile, sidecar)
 
     
 
@@ -44,19 +197,34 @@ def load_data(datafile, name):
     drop_cols = ['FBonset', 'FBDuration', 'actualFBOnsetTime', 
                  'actualOnsetTime', 'onset', 'displayFB',
                  'reward_amount', 'punishment_amount','stimulusCleared']
-    dfa = df.drop(set(drop_cols) & set(df.columns),1)
+    dfa = df.drop(columns = [c for c in drop_cols if c in df.columns])
 
     dfa['rep_resp'] = dfa.response.shift(1) == dfa.response
-    dfa['switch'] = (dfa.ts.shift(1)==dfa.ts).astype(int)
-    dfa['switch'].iloc[0]=False
+    switch = (dfa.ts.shift(1)==dfa.ts).astype(int)
+    switch.iloc[:1] = 0
+    dfa['switch'] = switch
+    # derived columns are computed on arrays: the stims as an (n,2) array
+    # (TS1's action, TS2's action) and the responses as floats (NaN if missing)
+    response = pd.to_numeric(dfa.response).to_numpy(dtype = float)
+    stim = np.array(list(dfa.stim), dtype = float).reshape(-1,2)
+    ts = dfa.ts.to_numpy(dtype = int)
     # label response as consistent with one task set or the other
-    dfa['cons_TS1'] = [int(dfa.response[i] == dfa.stim[i][0]) for i in dfa.index]
-    dfa['cons_TS2'] = [int(dfa.response[i] == dfa.stim[i][1]) for i in dfa.index]
-    dfa['subj_ts'] = [int(response in [2,3]) for response in dfa.response]
-    dfa['subj_switch'] = [int(dfa.subj_ts.shift(1)[i] != dfa.subj_ts[i]) for i in dfa.index]
-    dfa['correct'] = [dfa.response[i] == dfa.stim[i][dfa.ts[i]] for i in dfa.index]
-    dfa['stim_conform'] = [dfa.response.loc[i] in dfa.stim.loc[i] for i in dfa.index]
-    dfa = dfa.apply(lambda x: pd.to_numeric(x, errors='ignore'))
+    cons = response[:,None] == stim
+    dfa['cons_TS1'] = cons[:,0].astype(int)
+    dfa['cons_TS2'] = cons[:,1].astype(int)
+    subj_ts = np.isin(response, [2,3]).astype(int)
+    dfa['subj_ts'] = subj_ts
+    subj_switch = np.ones(len(subj_ts), dtype = int)
+    subj_switch[1:] = subj_ts[1:] != subj_ts[:-1]
+    dfa['subj_switch'] = subj_switch
+    dfa['correct'] = cons[np.arange(len(ts)), ts]
+    dfa['stim_conform'] = cons.any(1)
+    # convert columns that hold only numbers (e.g. response) to numeric dtypes
+    for col in dfa.columns:
+        try:
+            dfa[col] = pd.to_numeric(dfa[col])
+        except (ValueError, TypeError):
+            pass
     
     return (taskinfo, df,dfa)
 
@@ -5,39 +5,55 @@ Created on Sun May  8 23:41:57 2016
 @author: ian
 """
 
-from helper_functions import simulateModel
-from helper_classes import BiasPredModel
-from helper_functions import fit_bias2_model, fit_bias1_model, fit_static_model
-import random as r
+from model_recovery import run_recovery, run_model_comparison, confusion_matrix, \
+    bic_margins, model_names
+import argparse
  
 import pandas as pd
 from scipy.stats import norm
 import seaborn as sns
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--jobs', type = int, default = 1, 
+                    help = 'number of processes to run recovery points in')
+parser.add_argument('--points', type = int, default = 100, 
+                    help = 'number of recovery points per model')
+parser.add_argument('--seed', type = int, default = 0, 
+                    help = 'seed that every recovery point\'s random stream is spawned from')
+parser.add_argument('--models', nargs = '+', default = ['bias2'], choices = model_names)
+parser.add_argument('--compare', action = 'store_true', 
+                    help = 'also fit all models to each model\'s datasets and compare them by BIC')
+args = parser.parse_known_args()[0]
+
 ts_dis = [norm(-.3,.37), norm(.3,.37)]
 exp_len = 800
 p = .9
-num_sims = 100
-
-vals = []
-for i in range(num_sims):
-    if (i % 10 == 0):
-        print(i)
-    r1 = r.random()
-    r2 = r.random()
-    eps = r.random()
-    model = BiasPredModel(ts_dis, [.5,.5], r1, r2, TS_eps = eps)
-    df = simulateModel(model,ts_dis,'bias')
-    bias2 = fit_bias2_model(ts_dis, df, action_eps = 0, model_type = 'TS', print_out = False, return_out = False)
-    vals.append({'model_r1': r1, 'model_r2': r2, 'model_eps': eps, \
-            'recovered_r1': bias2['r1'], 'recovered_r2': bias2['r2'], 'recovered_eps': bias2['TS_eps']})
-            
-df = pd.DataFrame(vals)
-sns.heatmap(df.corr())
-sns.plt.scatter(df['model_r2'],df['recovered_r2'])
-
-
-clean_df = df.query('recovered_eps < .5')
-sns.heatmap(clean_df.corr())
-sns.plt.scatter(clean_df['model_r2'],clean_df['recovered_r2'])
+num_sims = args.points
+
+# results are appended as points finish, rerunning resumes an interrupted run
+recovery = run_recovery('Analysis_Output/recovery_seed%s.csv' % args.seed, args.models, 
+                        num_sims, args.seed, ts_dis, n = exp_len, p = p, jobs = args.jobs)
+if args.compare:
+    comparison = run_model_comparison('Analysis_Output/model_comparison_seed%s.csv' % args.seed,
+                                      args.models, num_sims, args.seed, ts_dis, n = exp_len, 
+                                      p = p, jobs = args.jobs)
+    print(confusion_matrix(comparison).round(2))
+    print(bic_margins(comparison).groupby('model')['margin'].describe())
+
+# correlation of the true and recovered values of each requested model's parameters
+print(recovery.groupby(['model', 'param'])[['true', 'recovered']].corr()
+      .xs('true', level = 2)['recovered'].round(2))
+
+# true against recovered bias2 parameters
+if 'bias2' in args.models:
+    bias2 = recovery.query('model == "bias2"').pivot(index = 'point', columns = 'param')
+    vals = {'model_r1': bias2['true']['r1'], 'model_r2': bias2['true']['r2'], 
+            'model_eps': bias2['true']['TS_eps'], 'recovered_r1': bias2['recovered']['r1'], 
+            'recovered_r2': bias2['recovered']['r2'], 'recovered_eps': bias2['recovered']['TS_eps']}
+    df = pd.DataFrame(vals)
+    sns.heatmap(df.corr())
+    sns.plt.scatter(df['model_r2'],df['recovered_r2'])
 
+    clean_df = df.query('recovered_eps < .5')
+    sns.heatmap(clean_df.corr())
+    sns.plt.scatter(clean_df['model_r2'],clean_df['recovered_r2'])
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent, content-addressed cache of model fits.
+
+Each fit is stored in its own pickle file named by a hash of everything the
+fit depends on: the subject's data, the model name, fixed arguments and the
+source of the fitting functions and model classes (which define the parameter
+bounds). Entries live in a directory per code version, so changing the fitting
+code starts a fresh directory and the old one can be evicted. Edits to the
+rest of helper_functions and helper_classes (plotting, posteriors) keep it.
+"""
+
+import hashlib, inspect, os, pickle, shutil, tempfile
+import numpy as np
+import pandas as pd
+from helper_functions import TrialData, get_trial_data
+
+def _update_hash(h, obj):
+    """
+    Feed a description of obj into the hash h. Handles the argument types the
+    fitting functions take: dataframes, arrays, frozen scipy distributions,
+    functions and (nested) containers of scalars
+    """
+    if isinstance(obj, pd.DataFrame):
+        # only the columns the fitting functions read
+        _update_hash(h, get_trial_data(obj))
+    elif isinstance(obj, TrialData):
+        h.update(b'TrialData')
+        _update_hash(h, dict(zip(obj.fields, obj.arrays())))
+    elif isinstance(obj, np.ndarray):
+        h.update(('ndarray%s%s' % (obj.dtype.str, obj.shape)).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif hasattr(obj, 'dist') and hasattr(obj, 'kwds'):
+        # frozen scipy distribution
+        _update_hash(h, (obj.dist.name, obj.args, obj.kwds))
+    elif inspect.isfunction(obj):
+        h.update(('function%s.%s' % (obj.__module__, obj.__name__)).encode())
+    elif isinstance(obj, dict):
+        h.update(b'dict')
+        for k in sorted(obj, key = repr):
+            _update_hash(h, k)
+            _update_hash(h, obj[k])
+    elif isinstance(obj, (list, tuple)):
+        h.update(('%s%s' % (type(obj).__name__, len(obj))).encode())
+        for item in obj:
+            _update_hash(h, item)
+    else:
+        h.update(repr(obj).encode())
+
+# the functions and classes, by module, that a fit's result depends on
+fit_code = {
+    'helper_functions': ['TrialData', 'get_trial_data', 'minimize_fit', 'fit_and_count',
+                         'bias_nll_grad', 'bias_objective', 'static_objective', 'bias_nll_batch',
+                         'fit_bias2_model', 'fit_bias1_model', 'fit_static_model',
+                         'fit_bias_family', 'midline_counts', 'switch_counts',
+                         'fit_midline_model', 'fit_switch_model', 'fit_memory_model',
+                         'model_log_likelihoods', 'get_model'],
+    'helper_classes': ['get_likelihoods', 'bias_forward', 'bias_forward_grad',
+                       'choice_log_likelihoods', 'BiasPredModel', 'SwitchModel',
+                       'MemoryModel'],
+}
+
+def get_code_version(code = fit_code):
+    """
+    Hash of the source of the fitting functions and model classes
+    :code: dict of module name -> names of the functions and classes to hash
+    """
+    h = hashlib.sha1()
+    for module_name in sorted(code):
+        module = __import__(module_name)
+        for name in code[module_name]:
+            h.update(('%s.%s' % (module_name, name)).encode())
+            h.update(inspect.getsource(getattr(module, name)).encode())
+    return h.hexdigest()[:12]
+
+class FitCache:
+    """
+    Cache of fitted parameters stored as one file per fit under
+    path/<code_version>/. Only the entries that are asked for are read. Writes
+    go to a temporary file that is renamed into place, so concurrent writers
+    never leave a partial entry behind.
+    """
+    def __init__(self, path = 'Analysis_Output/fit_cache', code_version = None):
+        if code_version is None:
+            code_version = get_code_version()
+        self.path = path
+        self.code_version = code_version
+        self.version_path = os.path.join(path, code_version)
+        if not os.path.exists(self.version_path):
+            os.makedirs(self.version_path)
+
+    def key(self, *parts):
+        """
+        Hash of everything a fit depends on, e.g.
+        cache.key(model_name, fitting_fun, fixed_args, data, ts_distributions)
+        """
+        h = hashlib.sha1(self.code_version.encode())
+        _update_hash(h, parts)
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.version_path, key + '.pkl')
+
+    def __contains__(self, key):
+        return os.path.exists(self._file(key))
+
+    def get(self, key, default = None):
+        try:
+            with open(self._file(key), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return default
+
+    def put(self, key, fit):
+        fd, tmp_file = tempfile.mkstemp(dir = self.version_path, suffix = '.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(fit, f, protocol = 2)
+            os.replace(tmp_file, self._file(key))
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+
+    def evict(self, keep = None):
+        """
+        Remove entries made by other versions of the fitting code. If keep (a
+        collection of keys) is passed, also remove the current version's
+        entries that aren't in it
+        """
+        for version in os.listdir(self.path):
+            version_path = os.path.join(self.path, version)
+            if version != self.code_version and os.path.isdir(version_path):
+                shutil.rmtree(version_path, ignore_errors = True)
+        if keep is not None:
+            keep = set(keep)
+            for filename in os.listdir(self.version_path):
+                key, ext = os.path.splitext(filename)
+                if ext == '.pkl' and key not in keep:
+                    try:
+                        os.remove(os.path.join(self.version_path, filename))
+                    except OSError:
+                        pass
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar store of the group trial data.
+
+Every subject's trials for each phase (train or test) are kept in one parquet
+file under path/phase=<phase>/id=<id>/, so reads can load just the columns they
+use and skip the files of subjects they don't need. Subsets of subjects (e.g.
+those who conform to the stimuli, or the learners) are stored as lists of ids
+in path/store.json rather than as copies of their rows, along with the order
+the subjects were written in and a manifest of the hashes of the raw data each
+subject was built from, so reruns can skip subjects whose data hasn't changed.
+
+Parquet has no tuples, so columns of tuples (stim) are stored as lists and
+turned back into tuples by read_group. Empty lists (the FB of test trials,
+which get no feedback) are stored as missing values, so FB reads back as a
+float column with NaN on those trials.
+"""
+
+import json, os, shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# dataframe index, stored as a column so per-subject trial numbers survive
+index_column = '_trial'
+# parquet metadata key listing a file's columns of tuples
+tuple_columns_key = b'tuple_columns'
+partitioning = ds.partitioning(pa.schema([('phase', pa.string()), ('id', pa.string())]),
+                               flavor = 'hive')
+
+def _read_index(path):
+    try:
+        with open(os.path.join(path, 'store.json')) as f:
+            return json.load(f)
+    except IOError:
+        return {'ids': {}, 'subsets': {}, 'manifest': {}}
+
+def _write_index(path, index):
+    tmp_file = os.path.join(path, 'store.json.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_file, os.path.join(path, 'store.json'))
+
+def _subject_file(path, phase, subj_id):
+    return os.path.join(path, 'phase=%s' % phase, 'id=%s' % subj_id, 'part-0.parquet')
+
+def _to_table(df):
+    """
+    Arrow table of df, with empty lists stored as missing values and the
+    columns of tuples listed in the table's metadata
+    """
+    df = df.copy()
+    tuple_columns = []
+    for col in df.columns[df.dtypes == object]:
+        values = df[col]
+        if values.map(lambda v: isinstance(v, list) and not v).any():
+            values = values.map(lambda v: np.nan if isinstance(v, list) and not v else v)
+            try:
+                values = pd.to_numeric(values)
+            except (ValueError, TypeError):
+                pass
+            df[col] = values
+        elif len(values) and values.map(lambda v: isinstance(v, tuple)).all():
+            tuple_columns.append(col)
+    table = pa.Table.from_pandas(df, preserve_index = False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[tuple_columns_key] = json.dumps(tuple_columns).encode()
+    return table.replace_schema_metadata(metadata)
+
+def write_subject(path, phase, subj_id, df):
+    """
+    Write (or overwrite) one subject's trials for a phase. The id column is
+    stored in the directory name rather than the file
+    """
+    subj_file = _subject_file(path, phase, subj_id)
+    os.makedirs(os.path.dirname(subj_file), exist_ok = True)
+    df = df.drop(columns = ['id'], errors = 'ignore')
+    df = df.rename_axis(index_column).reset_index()
+    pq.write_table(_to_table(df), subj_file)
+    index = _read_index(path)
+    ids = index['ids'].setdefault(phase, [])
+    if subj_id not in ids:
+        ids.append(subj_id)
+        _write_index(path, index)
+
+def remove_subject(path, subj_id):
+    """
+    Remove a subject's trials from every phase, and its manifest entry
+    """
+    index = _read_index(path)
+    for phase, ids in index['ids'].items():
+        if subj_id in ids:
+            shutil.rmtree(os.path.dirname(_subject_file(path, phase, subj_id)),
+                          ignore_errors = True)
+            ids.remove(subj_id)
+    index.get('manifest', {}).pop(subj_id, None)
+    if os.path.exists(path):
+        _write_index(path, index)
+
+def clear_store(path):
+    """
+    Remove every subject, subset and manifest entry
+    """
+    shutil.rmtree(path, ignore_errors = True)
+
+def read_manifest(path):
+    """
+    :return: dict of subject id -> hash of the data it was built from
+    """
+    return _read_index(path).get('manifest', {})
+
+def update_manifest(path, subj_id, data_hash):
+    """
+    Record the hash of the data a subject's stored trials were built from.
+    Call after the subject's phases are written, so an interrupted run leaves
+    the subject to be redone
+    """
+    os.makedirs(path, exist_ok = True)
+    index = _read_index(path)
+    index.setdefault('manifest', {})[subj_id] = data_hash
+    _write_index(path, index)
+
+def write_group(path, phase, df, replace = False):
+    """
+    Write a group dataframe with an id column, one file per subject
+    :replace: if True, first remove the phase's subjects that were already stored
+    """
+    if replace:
+        shutil.rmtree(os.path.join(path, 'phase=%s' % phase), ignore_errors = True)
+        index = _read_index(path)
+        if index['ids'].pop(phase, None) is not None:
+            _write_index(path, index)
+    for subj_id, subj_df in df.groupby('id', sort = False):
+        write_subject(path, phase, str(subj_id), subj_df)
+
+def write_subset(path, name, ids):
+    """
+    Store a subset of subjects by id
+    """
+    os.makedirs(path, exist_ok = True)
+    index = _read_index(path)
+    index['subsets'][name] = [str(subj_id) for subj_id in ids]
+    _write_index(path, index)
+
+def read_subset(path, name):
+    return _read_index(path)['subsets'][name]
+
+def subject_ids(path, phase):
+    """
+    Ids of the subjects written for a phase, in the order they were written
+    """
+    return _read_index(path)['ids'].get(phase, [])
+
+def read_group(path, phase, columns = None, ids = None, subset = None):
+    """
+    Read a phase's group dataframe
+    :columns: columns to load, or None for all of them
+    :ids: ids of the subjects to load, or None for all of them
+    :subset: name of a stored subset of subjects to restrict the load to
+    :return: dataframe with the subjects in the order they were written and
+        each subject's original trial index. Columns of tuples are tuples 
+        again, and stored empty lists are missing values
+    """
+    all_ids = subject_ids(path, phase)
+    if not all_ids:
+        return pd.DataFrame()
+    files = [_subject_file(path, phase, subj_id) for subj_id in all_ids]
+    schemas = [pq.read_schema(f) for f in files]
+    tuple_columns = set()
+    for file_schema in schemas:
+        tuple_columns.update(json.loads((file_schema.metadata or {}).get(tuple_columns_key, b'[]')))
+    # subjects can differ in which columns they have or in a column's type
+    # (e.g. all missing), so the dataset gets every file's columns
+    schema = pa.unify_schemas(schemas + [partitioning.schema])
+    dataset = ds.dataset(files, schema = schema, format = 'parquet', 
+                         partitioning = partitioning, partition_base_dir = path)
+    if columns is None:
+        columns = [col for col in schema.names if col != 'phase']
+    columns = [index_column] + [col for col in columns if col != index_column]
+    if subset is not None:
+        subset_ids = set(read_subset(path, subset))
+        ids = [subj_id for subj_id in (all_ids if ids is None else ids) if subj_id in subset_ids]
+    row_filter = None
+    if ids is not None:
+        row_filter = ds.field('id').isin([str(subj_id) for subj_id in ids])
+    table = dataset.to_table(columns = columns, filter = row_filter)
+    df = table.to_pandas().set_index(index_column)
+    df.index.name = None
+    for col in tuple_columns.intersection(df.columns):
+        df[col] = [tuple(np.asarray(v).tolist()) if isinstance(v, (np.ndarray, list)) else v 
+                   for v in df[col]]
+    return df
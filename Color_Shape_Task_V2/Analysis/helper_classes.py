@@ -7,9 +7,165 @@ Created on Tue Apr 14 18:09:29 2015
 
 import random as r
 import numpy as np
+from scipy.signal import lfilter
+
+# the context values the task produces (see sampleContexts): -1.1 + .2*bin
+# for the bins between the 11 boundaries in linspace(-1,1,11), clipped to [-1, 1]
+context_bins = np.unique(np.round(np.clip(-1.1 + .2*np.arange(12), -1, 1), 2))
+# likelihood tables over context_bins, keyed by the TS distribution parameters
+_likelihood_tables = {}
 
 def softmax(probs, inv_temp):
     return np.exp(probs*inv_temp)/sum(np.exp(probs*inv_temp))
+
+def get_likelihoods(likelihood_dist, contexts):
+    """
+    Likelihood of each context under each TS distribution. The densities at the
+    task's context values are computed once per set of distribution parameters
+    and shared by all models. Other contexts are evaluated directly.
+    :param likelihood_dist: list of frozen scipy distributions, one per TS
+    :param contexts: a single context value or an array of them
+    :return: array (n_TS,) for a single context or (n_contexts, n_TS)
+    """
+    contexts = np.asarray(contexts, dtype = float)
+    try:
+        key = tuple((dis.dist.name, dis.args, tuple(sorted(dis.kwds.items())))
+                    for dis in likelihood_dist)
+        table = _likelihood_tables.get(key)
+    except (AttributeError, TypeError):
+        # not a frozen scipy distribution, or unhashable parameters
+        key = table = None
+    if key is None:
+        return np.stack([dis.pdf(contexts) for dis in likelihood_dist], -1)
+    if table is None:
+        table = np.array([dis.pdf(context_bins) for dis in likelihood_dist]).T
+        _likelihood_tables[key] = table
+    flat = contexts.ravel()
+    bin_i = np.minimum(np.searchsorted(context_bins, flat), len(context_bins)-1)
+    binned = context_bins[bin_i] == flat
+    likelihoods = table[bin_i]
+    if not np.all(binned):
+        likelihoods[~binned] = np.array([dis.pdf(flat[~binned]) for dis in likelihood_dist]).T
+    return likelihoods.reshape(contexts.shape + (len(likelihood_dist),))
+
+def bias_forward(likelihoods, r1, r2, prior = [.5,.5]):
+    """
+    Run the BiasPredModel recursion over a whole sequence of trials. Each
+    trial's posterior is the normalized likelihood * prior, and the prior for
+    the next trial is the posterior passed through the transition matrix.
+    :param likelihoods: array (..., n_trials, 2) of TS likelihoods per trial
+    :param r1, r2: recursive probabilities. Scalars or arrays that broadcast
+        against the leading dimensions of likelihoods
+    :param prior: prior over TSs before the first trial
+    :return: posteriors (..., n_trials, 2) and the prior for the next trial
+    """
+    likelihoods = np.asarray(likelihoods, dtype = float)
+    r1 = np.asarray(r1, dtype = float)
+    r2 = np.asarray(r2, dtype = float)
+    prior = np.asarray(prior, dtype = float)
+    lead_shape = np.broadcast(likelihoods[..., 0, 0], r1, r2, prior[..., 0]).shape
+    n_trials = likelihoods.shape[-2]
+    if int(np.prod(lead_shape)) == 1:
+        # a single parameter point runs faster on Python floats than 0-d arrays
+        r1, r2 = float(r1.ravel()[0]), float(r2.ravel()[0])
+        p0, p1 = [float(p) for p in prior.reshape(-1, 2)[0]]
+        posteriors = []
+        for l0, l1 in likelihoods.reshape(-1, 2).tolist():
+            numer0 = l0 * p0
+            numer1 = l1 * p1
+            dinom = numer0 + numer1
+            post0 = numer0/dinom
+            post1 = numer1/dinom
+            posteriors.append((post0, post1))
+            p0 = r1*post0 + (1-r2)*post1
+            p1 = (1-r1)*post0 + r2*post1
+        posteriors = np.array(posteriors, dtype = float).reshape(lead_shape + (n_trials, 2))
+        return posteriors, np.array([p0, p1]).reshape(lead_shape + (2,))
+    posteriors = np.empty(lead_shape + (n_trials, 2))
+    p0 = np.broadcast_to(prior[..., 0], lead_shape)
+    p1 = np.broadcast_to(prior[..., 1], lead_shape)
+    for t in range(n_trials):
+        numer0 = likelihoods[..., t, 0] * p0
+        numer1 = likelihoods[..., t, 1] * p1
+        dinom = numer0 + numer1
+        post0 = numer0/dinom
+        post1 = numer1/dinom
+        posteriors[..., t, 0] = post0
+        posteriors[..., t, 1] = post1
+        p0 = r1*post0 + (1-r2)*post1
+        p1 = (1-r1)*post0 + r2*post1
+    next_prior = np.stack(np.broadcast_arrays(p0, p1), -1)
+    return posteriors, next_prior
+
+def bias_forward_grad(likelihoods, r1, r2, prior = [.5,.5]):
+    """
+    bias_forward for a single parameter point that also propagates the
+    derivatives of each trial's posterior with respect to r1 and r2.
+    Because the posteriors sum to 1, only d P(TS2) is returned.
+    :return: posteriors (n_trials, 2) and dpost (n_trials, 2), where column 0
+        is d P(TS2)/d r1 and column 1 is d P(TS2)/d r2
+    """
+    likelihoods = np.asarray(likelihoods, dtype = float)
+    n_trials = len(likelihoods)
+    post1 = np.empty(n_trials)
+    dpost = np.empty((n_trials, 2))
+    r1 = float(r1)
+    r2 = float(r2)
+    stay = r1+r2-1
+    p0, p1 = [float(p) for p in prior]
+    dp_r1 = dp_r2 = 0.0
+    for t, (l0, l1) in enumerate(likelihoods.tolist()):
+        dinom = l0*p0 + l1*p1
+        post = l1*p1/dinom
+        # d post/d p1, using p0 = 1-p1
+        slope = l0*l1/dinom**2
+        dpost_r1 = slope*dp_r1
+        dpost_r2 = slope*dp_r2
+        post1[t] = post
+        dpost[t] = dpost_r1, dpost_r2
+        # next prior: p1 = (1-r1)*(1-post) + r2*post
+        p1 = (1-r1)*(1-post) + r2*post
+        p0 = 1-p1
+        dp_r1 = post-1 + stay*dpost_r1
+        dp_r2 = post + stay*dpost_r2
+    posteriors = np.column_stack([1-post1, post1])
+    return posteriors, dpost
+
+def choice_log_likelihoods(TS_probs, choices, stims = None, action_eps = 0):
+    """
+    Log probability of each trial's choice given TS probabilities
+    :param TS_probs: array (..., n_trials, 2)
+    :param choices: TS choices, or responses if stims are passed
+    :param stims: optional (n_trials, 2) array of the actions associated with
+        each TS. Responses are scored with the action posterior, which mixes
+        in action_eps random responding over the 4 actions
+    :return: array (..., n_trials)
+    """
+    choices = np.asarray(choices, dtype = int)
+    if stims is None:
+        return np.log(np.take_along_axis(TS_probs, 
+                                         np.broadcast_to(choices[:, np.newaxis],
+                                                         TS_probs.shape[:-1] + (1,)),
+                                         -1)[..., 0])
+    matches = np.asarray(stims) == choices[:, np.newaxis]
+    choice_probs = (1-action_eps)*np.sum(TS_probs*matches, -1) + action_eps/4
+    return np.log(choice_probs)
+
+def action_probabilities(TS_probs, stims, action_eps = 0):
+    """
+    Batch version of the models' calc_action_posterior. Each TS's probability
+    goes to the action it is associated with on that trial, and action_eps
+    random responding is mixed in over the 4 actions
+    :param TS_probs: array (n_trials, 2)
+    :param stims: (n_trials, 2) array of the actions associated with each TS
+    :return: array (n_trials, 4)
+    """
+    stims = np.asarray(stims, dtype = int)
+    action_probs = np.zeros((len(TS_probs), 4))
+    trials = np.arange(len(TS_probs))
+    for i in range(stims.shape[1]):
+        action_probs[trials, stims[:, i]] = TS_probs[:, i]
+    return (1-action_eps)*action_probs+action_eps/4
     
 class BiasPredModel:
     """
@@ -46,7 +202,7 @@ class BiasPredModel:
            
         trans_probs = np.array([[r1, 1-r1], [1-r2, r2]]).transpose()            
         n = len(prior)
-        likelihood = np.array([dis.pdf(context) for dis in ld])
+        likelihood = get_likelihoods(ld, context).T
         numer = np.array([likelihood[i] * prior[i] for i in range(n)])
         dinom = np.sum(numer,0)
         posterior = numer/dinom
@@ -54,6 +210,33 @@ class BiasPredModel:
         self.posterior = posterior
         TS_probs = (1-eps)*posterior+eps/2  # mixed model of TS posteriors and random guessing
         return TS_probs
+
+    def calc_posteriors(self, contexts):
+        """
+        Batch version of calc_posterior. Runs the model over a whole sequence of
+        context points, updating the prior after each one, and returns the TS
+        probabilities for every trial as an (n_trials, 2) array. The model is left
+        in the same state as after calling calc_posterior on each context in turn
+        """
+        contexts = np.asarray(contexts, dtype = float)
+        eps = self.TS_eps
+        if len(contexts) == 0:
+            return np.empty((0, len(self.prior)))
+        likelihood = get_likelihoods(self.likelihood_dist, contexts)
+        posteriors, self.prior = bias_forward(likelihood, self.r1, self.r2, self.prior)
+        self.posterior = posteriors[-1]
+        TS_probs = (1-eps)*posteriors+eps/2
+        return TS_probs
+
+    def calc_log_likelihoods(self, contexts, choices, stims = None):
+        """
+        Log probability of each trial's choice under the model, computed with
+        calc_posteriors. If stims (n_trials x 2) are passed, choices are treated
+        as responses and scored with the action posterior, otherwise they are
+        treated as TS choices
+        """
+        TS_probs = self.calc_posteriors(contexts)
+        return choice_log_likelihoods(TS_probs, choices, stims, self.action_eps)
         
     def calc_action_posterior(self, stim, context):
         """
@@ -104,11 +287,68 @@ class MemoryModel:
         self.likelihood_dist = likelihood_dist
         self.k = k
         self.perseverance = perseverance
-        self.history= []
         self.TS_probs = []
         self.TS_eps = TS_eps
         self.bias = [1-bias, bias]
         self.action_eps = action_eps
+        self.reset()
+
+    def reset(self):
+        """
+        Clear the context history
+        """
+        self.avg_context = 0.0
+        self.weight_sum = 0.0
+
+    def get_state(self):
+        """
+        Snapshot of the context history, which can be restored with set_state
+        """
+        return (self.avg_context, self.weight_sum)
+
+    def set_state(self, state):
+        self.avg_context, self.weight_sum = state
+
+    def update_context(self, context):
+        """
+        Add a context point to the discounted context average. Gives the same
+        result as averaging the whole history with weights k**i (i = trials
+        since the context was seen) but only stores the running average and
+        the sum of the weights. k=0 reduces to the last context seen.
+        """
+        self.weight_sum = self.k*self.weight_sum + 1
+        self.avg_context += (context-self.avg_context)/self.weight_sum
+        return self.avg_context
+
+    def update_contexts(self, contexts):
+        """
+        Batch version of update_context. Returns the discounted context average
+        after each context point. For k <= 1 the discounted sums are run through
+        a linear filter. For k > 1 older points outweigh newer ones and the sums
+        grow like k**n, so they are scaled by k**-n, which makes them cumulative
+        sums. As in update_context, the weight sum can overflow to inf for
+        large k, after which new contexts no longer move the average.
+        """
+        contexts = np.asarray(contexts, dtype = float)
+        n = len(contexts)
+        if n == 0:
+            return contexts
+        k = np.float64(self.k)
+        deviations = contexts - self.avg_context
+        with np.errstate(over = 'ignore'):
+            if k <= 1:
+                dev_sums = lfilter([1], [1, -k], deviations)
+                weight_sums = lfilter([1], [1, -k], np.ones(n), zi = [k*self.weight_sum])[0]
+                last_weight = weight_sums[-1]
+            else:
+                scale = k**-np.arange(1., n+1)
+                dev_sums = np.cumsum(deviations*scale)
+                weight_sums = self.weight_sum + np.cumsum(scale)
+                last_weight = weight_sums[-1]*k**n
+        avg_contexts = self.avg_context + dev_sums/weight_sums
+        self.avg_context = avg_contexts[-1]
+        self.weight_sum = last_weight
+        return avg_contexts
         
     def calc_posterior(self, context, last_TS=None):
         """
@@ -124,9 +364,8 @@ class MemoryModel:
             TS_probs = []
             ld = self.likelihood_dist
             eps = self.TS_eps
-            self.history.append(context)
-            avg_context = np.average(self.history,weights = [self.k**i for i in range(len(self.history))][::-1])
-            likelihood = np.array([dis.pdf(avg_context) for dis in ld])
+            avg_context = self.update_context(context)
+            likelihood = get_likelihoods(ld, avg_context)
             likelihood = likelihood/np.sum(likelihood,0)
             TS_probs = likelihood
             TS_probs*= self.bias
@@ -137,24 +376,49 @@ class MemoryModel:
             self.TS_probs = TS_probs
             TS_probs = (1-eps)*TS_probs+eps/2  # mixed model of TS posteriors and random guessing
             return TS_probs
-           
+
+    def calc_posteriors(self, contexts, last_TSs):
+        """
+        Batch version of calc_posterior. Runs the model over a sequence of
+        context points, each paired with the TS chosen on the trial before it,
+        and returns the TS probabilities for every trial as an (n_trials, 2)
+        array. The model is left in the same state as after calling
+        calc_posterior on each context in turn
+        """
+        last_TSs = np.asarray(last_TSs, dtype = int)
+        eps = self.TS_eps
+        if len(last_TSs) == 0:
+            return np.empty((0, len(self.likelihood_dist)))
+        avg_contexts = self.update_contexts(contexts)
+        likelihood = get_likelihoods(self.likelihood_dist, avg_contexts)
+        likelihood = likelihood/np.sum(likelihood, -1, keepdims = True)
+        TS_probs = likelihood*self.bias
+        TS_probs = TS_probs/np.sum(TS_probs, -1, keepdims = True)
+        perseverance = np.zeros(TS_probs.shape)
+        perseverance[np.arange(len(last_TSs)), last_TSs] = 1
+        TS_probs = (1-self.perseverance)*TS_probs + self.perseverance*perseverance
+        self.TS_probs = TS_probs[-1]
+        return (1-eps)*TS_probs+eps/2
+
     def choose(self, mode = 'e-greedy', eps = None, inv_temp = 1):
-        n_choices = len(self.posterior)
+        # TS probabilities from the last calc_posterior, before TS_eps is mixed in
+        posterior = np.asarray(self.TS_probs)
+        n_choices = len(posterior)
         if eps == None:
             eps = self.TS_eps
         if mode == "e-greedy":
-            TS_probs = (1-eps)*self.posterior+eps/n_choices
+            TS_probs = (1-eps)*posterior+eps/n_choices
             return np.random.choice(range(n_choices), p = TS_probs)
         elif mode == 'prob_match':
-            return np.random.choice(range(n_choices), p = self.posterior)
+            return np.random.choice(range(n_choices), p = posterior)
         elif mode == "softmax":
-            probs = softmax(self.posterior, inv_temp)
+            probs = softmax(posterior, inv_temp)
             return np.random.choice(range(n_choices), p = probs)
         elif mode == 'mixture':
-            probs = (1-eps)*softmax(self.posterior, inv_temp)+eps/n_choices
+            probs = (1-eps)*softmax(posterior, inv_temp)+eps/n_choices
             return np.random.choice(range(n_choices), p = probs)
         else:
-            return np.argmax(self.posterior)
+            return np.argmax(posterior)
             
             
 class SwitchModel:
@@ -9,8 +9,14 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import pylab, lmfit
-import random as r
-from helper_classes import BiasPredModel, SwitchModel, MemoryModel, softmax
+import multiprocessing, traceback, collections, itertools, os, sys
+from scipy.special import xlogy
+from helper_classes import BiasPredModel, SwitchModel, MemoryModel, get_likelihoods, \
+    bias_forward, bias_forward_grad, choice_log_likelihoods, action_probabilities
+# the task-set sequence and context generators are shared with the task's
+# config generator in Exp_Design
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Exp_Design'))
+from util import genSeqs, sampleContexts
 
 def track_runs(iterable):
     """
@@ -40,7 +46,7 @@ def bar(x, y, title):
 
 def calc_posterior(data,prior,likelihood_dist, reduce = True):
     n = len(prior)
-    likelihood = [dis.pdf(data) for dis in likelihood_dist]
+    likelihood = get_likelihoods(likelihood_dist, data).T
     numer = np.array([likelihood[i] * prior[i] for i in range(n)])
     try:
         dinom = [np.sum(list(zip(*numer))[i]) for i in range(len(numer[0]))]
@@ -54,23 +60,11 @@ def calc_posterior(data,prior,likelihood_dist, reduce = True):
 
 def genSeq(n,p):
     """
-    Generates a sequence of binary values of length n such that the values 
+    Generates a sequence of binary values of length n-1 such that the values 
     switch with probability 1-p
     """
-    seq = [1]
-    while abs(np.mean(seq)-.5) > .1:
-        curr_state = round(r.random())
-        state_reps = 0
-        seq = []
-        for _ in range(n-1):
-            seq.append(curr_state)
-            if r.random() > p or state_reps > 25:
-                curr_state = 1-curr_state
-                state_reps = 0
-            else:
-                state_reps += 1
-    return seq
-                
+    return genSeqs(n-1, p)[0].tolist()
+
 def seqStats(n,p,reps):
     """ 
     simulate multiple sequences and calculate gross statistics
@@ -85,13 +79,8 @@ def seqStats(n,p,reps):
 def genExperimentSeq(n, p, ts_dis):
     """Generates an experiment seq
     """
-    bin_boundaries = np.linspace(-1,1,11)
     seq = genSeq(n,p)
-    context = []
-    for s in seq:
-        binned = -1.1 + np.digitize([ts_dis[s].rvs()],bin_boundaries)*.2
-        truncated_context = round(max(-1, min(1, binned[0])),2)
-        context.append(truncated_context)
+    context = sampleContexts(seq, ts_dis)
     df = pd.DataFrame({'context': pd.Series(context), 'ts': pd.Series(seq)})
     return df
 
@@ -106,51 +95,457 @@ def simulateModel(model, ts_dis, model_name = 'model', n = 800, p = .9, mode = '
     seq['posteriors'] = posteriors
     seq['model'] = model_name
     return seq
+
+def choiceProbs(posteriors, mode = 'e-greedy', eps = 0, inv_temp = 1):
+    """
+    Vectorized version of the models' choose rules. Returns the probability of
+    choosing each TS rather than a sampled choice.
+    :posteriors: array (..., 2) of TS posteriors
+    :eps, inv_temp: scalars or arrays that broadcast against posteriors[..., 0]
+    :return: array (..., 2) of choice probabilities
+    """
+    posteriors = np.asarray(posteriors, dtype = float)
+    n_choices = posteriors.shape[-1]
+    eps = np.asarray(eps, dtype = float)[..., None]
+    inv_temp = np.asarray(inv_temp, dtype = float)[..., None]
+    if mode == 'e-greedy':
+        return (1-eps)*posteriors+eps/n_choices
+    elif mode == 'prob_match':
+        return posteriors
+    elif mode in ('softmax', 'mixture'):
+        exp_post = np.exp(posteriors*inv_temp)
+        probs = exp_post/np.sum(exp_post, -1, keepdims = True)
+        if mode == 'mixture':
+            probs = (1-eps)*probs+eps/n_choices
+        return probs
+    else:
+        # argmax, first TS on ties like np.argmax
+        best = np.argmax(posteriors, -1)
+        return (best[..., None] == np.arange(n_choices)).astype(float)
+
+def _markov_choices(draws, p_TS2):
+    """
+    Sample choices that depend on the last choice for all trials at once.
+    Choice t is draws[t] < p_TS2[t, last choice], as in a trial by trial loop.
+    Given its uniform draw, each trial either sets the choice whatever the last
+    one was, keeps the last choice or flips it, so every choice is the last
+    set choice flipped once per flipping trial since
+    :draws: uniform draws (..., n_trials)
+    :p_TS2: probability of choosing TS2 given each last choice (..., n_trials, 2).
+        The first trial has no last choice, so its two columns should be equal
+    :return: int choices (..., n_trials)
+    """
+    after_TS1 = draws < p_TS2[..., 0]
+    after_TS2 = draws < p_TS2[..., 1]
+    sets = after_TS1 == after_TS2
+    sets[..., 0] = True
+    flips = np.cumsum(after_TS1 & ~after_TS2, -1)
+    trials = np.arange(draws.shape[-1])
+    last_set = np.maximum.accumulate(np.where(sets, trials, 0), -1)
+    set_choice = np.take_along_axis(after_TS1, last_set, -1)
+    flipped = flips - np.take_along_axis(flips, last_set, -1)
+    return (set_choice ^ (flipped % 2 == 1)).astype(int)
+
+def simulateModels(params, ts_dis, model_name = 'bias', n = 800, p = .9, 
+                   mode = 'e-greedy', inv_temp = 1, rng = None, model_type = 'bias'):
+    """
+    Population version of simulateModel. Every agent gets its own sequence and
+    parameters, and all agents are simulated together as arrays.
+    :params: DataFrame or dict with one value per agent of the model's 
+        parameters: r1, r2 and TS_eps for 'bias', r1, r2 and eps for 'switch'
+        and k, perseverance, bias and TS_eps for 'memory'
+    :model_type: 'bias' (BiasPredModel), 'switch' (SwitchModel) or 'memory'
+        (MemoryModel). The switch and memory models depend on the last choice,
+        so their first trial is at chance
+    :inv_temp: used by the softmax and mixture modes. Scalar or one per agent
+    :rng: seed or RandomState. None uses the global numpy state
+    :return: long-format DataFrame with one row per agent and trial
+    """
+    if rng is None:
+        rng = np.random
+    elif not isinstance(rng, np.random.RandomState):
+        rng = np.random.RandomState(rng)
+    params = pd.DataFrame(params).reset_index(drop = True)
+    n_sims = len(params)
+    seqs = genSeqs(n-1, p, n_sims, rng = rng)
+    contexts = sampleContexts(seqs, ts_dis, random_state = rng)
+    n_trials = seqs.shape[1]
+    inv_temp = np.reshape(inv_temp, (-1, 1))
+    if model_type == 'bias':
+        eps = params['TS_eps'].values
+        likelihoods = get_likelihoods(ts_dis, contexts)
+        posteriors, _ = bias_forward(likelihoods, params['r1'].values, params['r2'].values, 
+                                     [.5,.5])
+        TS_probs = (1-eps[:, None, None])*posteriors+eps[:, None, None]/2
+        # choose uses the raw posteriors and mixes in TS_eps itself
+        probs = choiceProbs(posteriors, mode, eps[:, None], inv_temp)
+        choices = (rng.random_sample(seqs.shape) < probs[..., 1]).astype(int)
+        p_TS2 = TS_probs[..., 1]
+    else:
+        # posteriors given each last choice, indexed [agent, trial, last choice, TS]
+        if model_type == 'switch':
+            eps = params['eps'].values
+            r1, r2 = params['r1'].values, params['r2'].values
+            trans_probs = np.stack([np.column_stack([r1, 1-r1]), 
+                                    np.column_stack([1-r2, r2])], 1)
+            posteriors = np.broadcast_to(trans_probs[:, None], (n_sims, n_trials, 2, 2))
+        elif model_type == 'memory':
+            eps = params['TS_eps'].values
+            # the discounted context averages don't depend on the choices. The
+            # first trial, with no last choice, isn't added to them
+            context_probs = np.full((n_sims, n_trials, 2), .5)
+            for i in range(n_sims):
+                model = MemoryModel(ts_dis, k = params['k'].values[i], 
+                                    bias = params['bias'].values[i])
+                context_probs[i, 1:] = model.calc_posteriors(contexts[i, 1:], 
+                                                             np.zeros(n_trials-1))
+            perseverance = params['perseverance'].values[:, None, None, None]
+            posteriors = (1-perseverance)*context_probs[:, :, None] + perseverance*np.eye(2)
+        TS_probs = (1-eps[:, None, None, None])*posteriors+eps[:, None, None, None]/2
+        probs = choiceProbs(posteriors, mode, eps[:, None, None], inv_temp[..., None])
+        choice_p_TS2 = probs[..., 1].copy()
+        choice_p_TS2[:, 0] = .5
+        choices = _markov_choices(rng.random_sample(seqs.shape), choice_p_TS2)
+        last_choices = np.column_stack([np.zeros(n_sims, dtype = int), choices[:, :-1]])
+        p_TS2 = np.take_along_axis(TS_probs[..., 1], last_choices[..., None], -1)[..., 0]
+        p_TS2[:, 0] = .5
+    
+    columns = {'sim': np.repeat(np.arange(n_sims), n_trials),
+               'trial': np.tile(np.arange(n_trials), n_sims),
+               'context': contexts.ravel(),
+               'ts': seqs.ravel(),
+               'subj_ts': choices.ravel(),
+               model_name + '_posterior': p_TS2.ravel()}
+    for name in params.columns:
+        columns[name] = np.repeat(params[name].values, n_trials)
+    columns['model'] = model_name
+    return pd.DataFrame(columns)
           
 
+#*********************************************
+# Trial data
+#*********************************************
+
+class TrialData:
+    """
+    Read-only NumPy arrays of the trial data that models are fit to, extracted
+    once from a subject's dataframe so objective functions don't do pandas
+    lookups on every evaluation. Slicing (data[i:j]) returns a TrialData of
+    views, like df.iloc. Pickles as just the arrays.
+    :context: (n,) float contexts
+    :subj_ts: (n,) int TS choices
+    :stim: (n, 2) int actions associated with TS1 and TS2, or None
+    :response: (n,) int responses, or None
+    """
+    fields = ('context', 'subj_ts', 'stim', 'response')
+
+    def __init__(self, context, subj_ts, stim = None, response = None):
+        self.context = np.asarray(context, dtype = float)
+        self.subj_ts = np.asarray(subj_ts, dtype = int)
+        self.stim = None if stim is None else np.asarray(stim, dtype = int)
+        self.response = None if response is None else np.asarray(response, dtype = int)
+        for field in self.fields:
+            values = getattr(self, field)
+            if values is not None:
+                values.flags.writeable = False
+
+    def __len__(self):
+        return len(self.context)
+
+    def __getitem__(self, index):
+        return TrialData(*[None if values is None else values[index]
+                           for values in self.arrays()])
+
+    def __reduce__(self):
+        return (TrialData, self.arrays())
+
+    def arrays(self):
+        return tuple(getattr(self, field) for field in self.fields)
+
+def get_trial_data(data):
+    """
+    Convert a subject's dataframe to TrialData. TrialData is passed through,
+    and stim/response are left out if the dataframe doesn't have them
+    """
+    if isinstance(data, TrialData):
+        return data
+    stim = response = None
+    if 'stim' in data.columns and 'response' in data.columns:
+        stim = np.array(list(data.stim), dtype = int).reshape(-1, 2)
+        response = data.response.values
+    return TrialData(data.context.values, data.subj_ts.values, stim, response)
+
+def fold_blocks(n_trials, n_folds = 2):
+    """
+    Split n_trials into n_folds contiguous blocks of (nearly) equal size
+    :return: list of slices
+    """
+    bounds = [int(n_trials*i/n_folds) for i in range(n_folds+1)]
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+def get_cv_splits(data, n_folds = 2):
+    """
+    Training sets for contiguous-block cross-validation, taken from one
+    TrialData so the folds share its arrays. '_fold<i>' holds every trial
+    but block i, which is held out to test on, and '_fullRun' holds every
+    trial. The trials on either side of a held-out block are joined, so
+    sequential models run straight across the gap. With 2 folds, '_fold0' is 
+    the second half and '_fold1' the first half
+    :return: dict of split name -> TrialData, and the held-out slice of each fold
+    """
+    if n_folds < 2:
+        raise ValueError('n_folds must be at least 2, got %s' % n_folds)
+    trials = get_trial_data(data)
+    n_trials = len(trials)
+    blocks = fold_blocks(n_trials, n_folds)
+    splits = {'_fullRun': trials}
+    held_out = {}
+    for i, block in enumerate(blocks):
+        if block.start == 0:
+            train = slice(block.stop, n_trials)
+        elif block.stop == n_trials:
+            train = slice(0, block.start)
+        else:
+            train = np.r_[0:block.start, block.stop:n_trials]
+        splits['_fold%s' % i] = trials[train]
+        held_out['_fold%s' % i] = block
+    return splits, held_out
+
 #*********************************************
 # Model fitting functions
 #*********************************************
 #def fit_model(data, printout = True, return_out = False, **args):
+
+def minimize_fit(errfunc, fit_params, kws, jac = None, init = None, n_restarts = 0, 
+                 rng = None, agree_tol = 1e-3, batch_errfunc = None, n_candidates = None):
+    """
+    Optimizer driver shared by the fit_* functions. Runs L-BFGS-B from the
+    default parameter values, or from init where it is given (e.g. the fit to
+    the full run when fitting half of it), then from up to n_restarts random
+    points. The restarts are the best scoring of n_candidates points drawn at
+    once within the parameter bounds. Restarts stop early once two runs agree
+    on the best objective value to within agree_tol.
+    :rng: seed, numpy Generator/RandomState or None for the global state
+    :batch_errfunc: function giving the objective at each row of an array
+        (n_points, n_varying_params) of points, e.g. from bias_nll_batch, to
+        score the candidates in one call. If None they are scored one by one
+    :n_candidates: number of random points to score, default 10*n_restarts
+    :return: the best lmfit result, with nfev set to the number of objective
+        evaluations over all runs and candidates, n_starts to the number of 
+        runs and objective_value to the objective at the best parameters
+    """
+    fit_params = fit_params.copy()
+    vary = [name for name, par in fit_params.items() if par.vary]
+    if init:
+        for name in vary:
+            if name in init:
+                par = fit_params[name]
+                par.value = float(np.clip(init[name], par.min, par.max))
+    minimize_kws = {'method': 'lbfgsb', 'kws': kws}
+    if jac is not None:
+        minimize_kws['jac'] = jac
+    best = lmfit.minimize(errfunc, fit_params, **minimize_kws)
+    best_value = errfunc(best.params, **kws)
+    nfev = best.nfev + 1
+    n_starts = 1
+    if n_restarts > 0 and vary:
+        if rng is None:
+            rng = np.random
+        elif isinstance(rng, int):
+            rng = np.random.RandomState(rng)
+        values = np.array([fit_params[name].value for name in vary])
+        low = np.array([fit_params[name].min for name in vary], dtype = float)
+        high = np.array([fit_params[name].max for name in vary], dtype = float)
+        # parameters without a bound are drawn up to twice their start value
+        spread = np.maximum(2*np.abs(values), 1)
+        low = np.where(np.isfinite(low), low, values-spread)
+        high = np.where(np.isfinite(high), high, values+spread)
+        if n_candidates is None:
+            n_candidates = 10*n_restarts
+        candidates = rng.uniform(low, high, size = (max(n_candidates, n_restarts), len(vary)))
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            if batch_errfunc is not None:
+                scores = np.asarray(batch_errfunc(candidates), dtype = float)
+            else:
+                scores = np.empty(len(candidates))
+                for i, candidate in enumerate(candidates):
+                    for name, value in zip(vary, candidate):
+                        fit_params[name].value = value
+                    scores[i] = errfunc(fit_params, **kws)
+        nfev += len(candidates)
+        # NaN scores sort last
+        starts = candidates[np.argsort(scores, kind = 'stable')[:n_restarts]]
+        n_agree = 1
+        for start in starts:
+            for name, value in zip(vary, start):
+                fit_params[name].value = value
+            out = lmfit.minimize(errfunc, fit_params, **minimize_kws)
+            value = errfunc(out.params, **kws)
+            nfev += out.nfev + 1
+            n_starts += 1
+            if value < best_value - agree_tol:
+                best, best_value, n_agree = out, value, 1
+            elif abs(value - best_value) <= agree_tol:
+                n_agree += 1
+                if n_agree >= 2:
+                    break
+    best.nfev = nfev
+    best.objective_value = best_value
+    best.n_starts = n_starts
+    return best
+
+def fit_and_count(fun, *args, **kwargs):
+    """
+    Run a fit_* function and return its fitted parameters along with the number
+    of objective evaluations the fit used. Functions that fit several models
+    (fit_bias_family) give dicts of both, keyed by model name
+    """
+    out = fun(*args, return_out = True, **kwargs)
+    if isinstance(out, dict):
+        return ({name: o.params.valuesdict() for name, o in out.items()},
+                {name: o.nfev for name, o in out.items()})
+    return out.params.valuesdict(), out.nfev
     
-    
+def bias_nll(model, df, model_type = 'TS'):
+    """
+    Negative log likelihood of a subject's choices under a BiasPredModel,
+    scored over the whole session with the model's batch forward pass
+    :model_type: 'TS' scores subj_ts choices, 'action' scores responses
+    """
+    df = get_trial_data(df)
+    if model_type == 'TS':
+        loglik = model.calc_log_likelihoods(df.context, df.subj_ts)
+    elif model_type == 'action':
+        loglik = model.calc_log_likelihoods(df.context, df.response, df.stim)
+    return -np.sum(loglik)
+
+def bias_nll_grad(train_ts_dis, df, r1, r2, TS_eps, init_prior = [.5,.5], 
+                  action_eps = 0, model_type = 'TS'):
+    """
+    Negative log likelihood of the bias model and its exact gradient with
+    respect to (r1, r2, TS_eps), from a single forward pass
+    :return: nll, array (3,) gradient
+    """
+    df = get_trial_data(df)
+    likelihood = get_likelihoods(train_ts_dis, df.context)
+    posteriors, dpost = bias_forward_grad(likelihood, r1, r2, init_prior)
+    if model_type == 'TS':
+        matches = df.subj_ts[:, np.newaxis] == np.array([0,1])
+        action_eps = 0
+    elif model_type == 'action':
+        matches = df.stim == df.response[:, np.newaxis]
+    TS_probs = (1-TS_eps)*posteriors+TS_eps/2
+    choice_probs = (1-action_eps)*np.sum(TS_probs*matches, 1) + action_eps/4
+    # derivatives of the chosen TS's probability. P(TS1) moves opposite to P(TS2)
+    dTS2 = np.column_stack([(1-TS_eps)*dpost, .5-posteriors[:,1]])
+    dTS1 = np.column_stack([-(1-TS_eps)*dpost, .5-posteriors[:,0]])
+    dchoice = (1-action_eps)*(matches[:, 0:1]*dTS1 + matches[:, 1:2]*dTS2)
+    nll = -np.sum(np.log(choice_probs))
+    grad = -np.sum(dchoice/choice_probs[:, np.newaxis], 0)
+    return nll, grad
+
+def bias_objective(train_ts_dis, action_eps = 0, model_type = 'TS'):
+    """
+    Returns f(r1, r2, TS_eps, df) -> (nll, gradient) for the bias-model fits.
+    The last evaluation is cached, so an optimizer asking for the objective and
+    then the gradient at the same point only runs the forward pass once
+    """
+    last = {}
+    def objective(r1, r2, TS_eps, df):
+        key = (float(r1), float(r2), float(TS_eps), id(df))
+        if key not in last:
+            last.clear()
+            last[key] = bias_nll_grad(train_ts_dis, df, r1, r2, TS_eps, 
+                                      action_eps = action_eps, 
+                                      model_type = model_type)
+        return last[key]
+    return objective
+
+def static_objective(train_ts_dis, data, rp, init_prior = [.5,.5], action_eps = 0, 
+                     model_type = 'TS'):
+    """
+    Returns f(TS_eps) -> (nll, gradient) for the fixed-rp bias models. With r1
+    and r2 fixed the posteriors don't depend on TS_eps, so they come from one
+    forward pass and each choice's probability is linear in TS_eps:
+    c0 + TS_eps*c1
+    """
+    data = get_trial_data(data)
+    likelihood = get_likelihoods(train_ts_dis, data.context)
+    posteriors, _ = bias_forward(likelihood, rp, rp, init_prior)
+    if model_type == 'TS':
+        matches = data.subj_ts[:, np.newaxis] == np.array([0,1])
+        action_eps = 0
+    elif model_type == 'action':
+        matches = data.stim == data.response[:, np.newaxis]
+    chosen = np.sum(posteriors*matches, 1)
+    c0 = (1-action_eps)*chosen + action_eps/4
+    c1 = (1-action_eps)*(np.sum(matches, 1)/2 - chosen)
+    def objective(TS_eps):
+        choice_probs = c0 + TS_eps*c1
+        return -np.sum(np.log(choice_probs)), -np.sum(c1/choice_probs)
+    return objective
+
+def bias_nll_batch(train_ts_dis, data, params, init_prior = [.5,.5], 
+                   action_eps = 0, model_type = 'TS', chunk_size = 1000):
+    """
+    Negative log likelihood of a subject's choices under the bias model for many
+    parameter points at once. The forward pass is broadcast over a
+    (P, n_trials, 2) state, so a whole grid costs about as much as a few
+    single evaluations. bias1, eoptimal and ignore points are rows with r1 = r2.
+    :params: array (P, 3) of (r1, r2, TS_eps) rows
+    :chunk_size: number of parameter points evaluated together, to bound memory
+    :return: array (P,) of negative log likelihoods
+    """
+    params = np.atleast_2d(np.asarray(params, dtype = float))
+    data = get_trial_data(data)
+    likelihood = get_likelihoods(train_ts_dis, data.context)
+    if model_type == 'TS':
+        choices, stims = data.subj_ts, None
+    elif model_type == 'action':
+        choices, stims = data.response, data.stim
+    nll = np.empty(len(params))
+    for start in range(0, len(params), chunk_size):
+        r1, r2, eps = params[start:start+chunk_size].T
+        posteriors, _ = bias_forward(likelihood, r1, r2, init_prior)
+        eps = eps[:, np.newaxis, np.newaxis]
+        TS_probs = (1-eps)*posteriors+eps/2
+        loglik = choice_log_likelihoods(TS_probs, choices, stims, action_eps)
+        nll[start:start+chunk_size] = -np.sum(loglik, -1)
+    return nll
+
 
 
 def fit_bias2_model(train_ts_dis, data, init_prior = [.5,.5], action_eps = 0, 
-                    model_type = 'action', verbose = True, return_out = False):
+                    model_type = 'action', verbose = True, return_out = False,
+                    init = None, n_restarts = 0, rng = None, objective = None):
     """
     Function to fit parameters to the bias2 model (fit r1, r2 and epsilon).
     Model can either fit to TS choices or actions
+    :objective: from bias_objective, to share its cache with other fits
     """
+    if objective is None:
+        objective = bias_objective(train_ts_dis, action_eps, model_type)
     def errfunc(params,df):
-        r1 = params['r1']
-        r2 = params['r2']
-        eps = params['TS_eps']
-    
-        init_prior = [.5,.5]
-        model = BiasPredModel(train_ts_dis, init_prior, r1=r1, r2=r2, 
-                              TS_eps=eps, action_eps = action_eps)
-        model_likelihoods = []
-        for i in df.index:
-            c = df.context[i]
-            TS_choice = df.subj_ts[i]
-            if model_type == 'TS':
-                TS_probs = model.calc_posterior(c)
-                model_likelihoods.append(TS_probs[TS_choice])
-            elif model_type == 'action':
-                s = df.stim[i]
-                response_choice = df.response[i]
-                action_probs = model.calc_action_posterior(s,c)
-                model_likelihoods.append(action_probs[response_choice])
+        r1 = params['r1'].value
+        r2 = params['r2'].value
+        eps = params['TS_eps'].value
         # minimize
-        return abs(np.sum(np.log(np.array(model_likelihoods)))) # single value
+        return objective(r1, r2, eps, df)[0] # single value
+    
+    def gradfunc(params,df):
+        return objective(params['r1'].value, params['r2'].value, 
+                         params['TS_eps'].value, df)[1]
     
     # Fit bias model
     fit_params = lmfit.Parameters()
     fit_params.add('r1', value=.5, min=0, max=1)
     fit_params.add('r2', value=.5, min=0, max=1)
     fit_params.add('TS_eps', value=.1, min=0, max=1)
-    out = lmfit.minimize(errfunc, fit_params, method = 'lbfgsb', kws={'df': data})
+    data = get_trial_data(data)
+    batch_errfunc = lambda points: bias_nll_batch(train_ts_dis, data, points, init_prior, 
+                                                  action_eps, model_type)
+    out = minimize_fit(errfunc, fit_params, {'df': data}, jac = gradfunc, init = init, 
+                       n_restarts = n_restarts, rng = rng, batch_errfunc = batch_errfunc)
     if verbose:
         lmfit.report_fit(out)
     if return_out:
@@ -159,38 +554,35 @@ def fit_bias2_model(train_ts_dis, data, init_prior = [.5,.5], action_eps = 0,
         return out.params.valuesdict()
     
 def fit_bias1_model(train_ts_dis, data, init_prior = [.5,.5], action_eps = 0, 
-                    model_type = 'action', verbose = True, return_out = False):
+                    model_type = 'action', verbose = True, return_out = False,
+                    init = None, n_restarts = 0, rng = None, objective = None):
     """
     Function to fit parameters to the bias2 model (fit r and epsilon)
+    :objective: from bias_objective, to share its cache with other fits
     """
+    if objective is None:
+        objective = bias_objective(train_ts_dis, action_eps, model_type)
     def errfunc(params,df):
-        r1 = params['rp']
-        r2 = params['rp']
-        eps = params['TS_eps']
-
-        init_prior = [.5,.5]
-        model = BiasPredModel(train_ts_dis, init_prior, r1=r1, r2=r2, 
-                              TS_eps=eps, action_eps = action_eps)
-        model_likelihoods = []
-        for i in df.index:
-            c = df.context[i]
-            TS_choice = df.subj_ts[i]
-            if model_type == 'TS':
-                TS_probs = model.calc_posterior(c)
-                model_likelihoods.append(TS_probs[TS_choice])
-            elif model_type == 'action':
-                s = df.stim[i]
-                response_choice = df.response[i]
-                action_probs = model.calc_action_posterior(s,c)
-                model_likelihoods.append(action_probs[response_choice])
+        rp = params['rp'].value
+        eps = params['TS_eps'].value
         # minimize
-        return abs(np.sum(np.log(np.array(model_likelihoods)))) # single value
+        return objective(rp, rp, eps, df)[0] # single value
+    
+    def gradfunc(params,df):
+        rp = params['rp'].value
+        grad = objective(rp, rp, params['TS_eps'].value, df)[1]
+        return np.array([grad[0]+grad[1], grad[2]])
     
     # Fit bias model
     fit_params = lmfit.Parameters()
     fit_params.add('rp', value=.5, min=0, max=1)
     fit_params.add('TS_eps', value = .1, min=0, max=1)
-    out = lmfit.minimize(errfunc, fit_params, method = 'lbfgsb', kws={'df': data})
+    data = get_trial_data(data)
+    # points are (rp, TS_eps)
+    batch_errfunc = lambda points: bias_nll_batch(train_ts_dis, data, points[:, [0,0,1]], 
+                                                  init_prior, action_eps, model_type)
+    out = minimize_fit(errfunc, fit_params, {'df': data}, jac = gradfunc, init = init, 
+                       n_restarts = n_restarts, rng = rng, batch_errfunc = batch_errfunc)
     if verbose:
         lmfit.report_fit(out)
     if return_out:
@@ -200,57 +592,121 @@ def fit_bias1_model(train_ts_dis, data, init_prior = [.5,.5], action_eps = 0,
     
 def fit_static_model(train_ts_dis, data, rp, init_prior = [.5,.5], 
                      action_eps = 0, model_type = 'action', verbose = True, 
-                     return_out = False):
+                     return_out = False, init = None, n_restarts = 0, rng = None):
     """
     Function to fit any model where recursive probabilities are fixed, like an
     optimal model (r1=r2=.9) or a base-rate neglect model (r1=r2=.5)
     """
+    objective = static_objective(train_ts_dis, data, rp, init_prior, action_eps, 
+                                 model_type)
     def errfunc(params,df):
-        eps = params['TS_eps']
-
-        init_prior = [.5,.5]
-        model = BiasPredModel(train_ts_dis, init_prior, rp = rp, TS_eps=eps, action_eps = action_eps)
-        model_likelihoods = []
-        for i in df.index:
-            c = df.context[i]
-            TS_choice = df.subj_ts[i]
-            if model_type == 'TS':
-                TS_probs = model.calc_posterior(c)
-                model_likelihoods.append(TS_probs[TS_choice])
-            elif model_type == 'action':
-                s = df.stim[i]
-                response_choice = df.response[i]
-                action_probs = model.calc_action_posterior(s,c)
-                model_likelihoods.append(action_probs[response_choice])
+        eps = params['TS_eps'].value
         # minimize
-        return abs(np.sum(np.log(np.array(model_likelihoods)))) # single value
+        return objective(eps)[0] # single value
+    
+    def gradfunc(params,df):
+        return np.array([objective(params['TS_eps'].value)[1]])
     
     # Fit bias model
     fit_params = lmfit.Parameters()
     fit_params.add('TS_eps', value = .1, min=0, max=1)
-    out = lmfit.minimize(errfunc, fit_params, method = 'lbfgsb', kws={'df': data})
+    fit_params.add('rp', value = rp, vary = False)
+    data = get_trial_data(data)
+    # points are (TS_eps,)
+    batch_errfunc = lambda points: bias_nll_batch(train_ts_dis, data, 
+                                                  np.column_stack([np.full(len(points), rp), 
+                                                                   np.full(len(points), rp), 
+                                                                   points[:, 0]]),
+                                                  init_prior, action_eps, model_type)
+    out = minimize_fit(errfunc, fit_params, {'df': data}, jac = gradfunc, init = init, 
+                       n_restarts = n_restarts, rng = rng, batch_errfunc = batch_errfunc)
     if verbose:
         lmfit.report_fit(out)
     fit_params = out.params.valuesdict()
-    fit_params['rp'] = rp
     if return_out:
         return out
     else:
         return fit_params
 
-def fit_midline_model(data, verbose = True, return_out = False):
-    def midline_errfunc(params,df):
+def fit_bias_family(train_ts_dis, data, rp, init_prior = [.5,.5], action_eps = 0, 
+                    model_type = 'action', verbose = True, return_out = False,
+                    init = None, n_restarts = 0, rng = None):
+    """
+    Fit the nested bias models to one subject's data together: ignore (r1=r2=.5),
+    eoptimal (r1=r2=rp), bias1 (r1=r2) and bias2. The fixed-rp models each take
+    one forward pass. bias1 starts from the better of them and bias2 from bias1,
+    unless the start passed in init scores better, and bias1 and bias2 share one
+    objective so the nested start isn't recomputed
+    :init: dict of model name -> starting values, e.g. the fits to the full run
+    :return: dict of model name -> fitted parameters (or lmfit results)
+    """
+    data = get_trial_data(data)
+    init = init or {}
+    objective = bias_objective(train_ts_dis, action_eps, model_type)
+    def best_start(nested, name):
+        # only score the starts if init gives a second one
+        if name not in init:
+            return nested
+        nll = lambda params: objective(params.get('r1', params.get('rp')), 
+                                       params.get('r2', params.get('rp')),
+                                       params['TS_eps'], data)[0]
+        return min([nested, init[name]], key = nll)
+    outs = {}
+    for name, static_rp in [('ignore', .5), ('eoptimal', rp)]:
+        outs[name] = fit_static_model(train_ts_dis, data, static_rp, init_prior, 
+                                      action_eps, model_type, verbose, True, 
+                                      init.get(name), n_restarts, rng)
+    nested = min([outs['ignore'], outs['eoptimal']], 
+                 key = lambda out: out.objective_value).params.valuesdict()
+    outs['bias1'] = fit_bias1_model(train_ts_dis, data, init_prior, action_eps, 
+                                    model_type, verbose, True, best_start(nested, 'bias1'), 
+                                    n_restarts, rng, objective = objective)
+    nested = outs['bias1'].params.valuesdict()
+    nested = {'r1': nested['rp'], 'r2': nested['rp'], 'TS_eps': nested['TS_eps']}
+    outs['bias2'] = fit_bias2_model(train_ts_dis, data, init_prior, action_eps, 
+                                    model_type, verbose, True, best_start(nested, 'bias2'), 
+                                    n_restarts, rng, objective = objective)
+    if return_out:
+        return outs
+    else:
+        return {name: out.params.valuesdict() for name, out in outs.items()}
+
+def midline_counts(data):
+    """
+    The midline likelihood only depends on how many TS choices agree with the
+    side of the midline the context falls on (contexts <= 0 predict TS1)
+    :return: (n_agree, n_disagree)
+    """
+    data = get_trial_data(data)
+    context_sgn = np.maximum(np.sign(data.context), 0)
+    n_agree = int(np.sum(data.subj_ts == context_sgn))
+    return n_agree, len(data) - n_agree
+
+def switch_counts(data):
+    """
+    The switch likelihood only depends on the (previous choice, current choice)
+    transitions after the first trial
+    :return: 2x2 array, counts[last_choice, choice]
+    """
+    choices = get_trial_data(data).subj_ts
+    counts = np.zeros((2,2), dtype = int)
+    np.add.at(counts, (choices[:-1], choices[1:]), 1)
+    return counts
+
+def fit_midline_model(data, verbose = True, return_out = False, init = None, 
+                      n_restarts = 0, rng = None):
+    def midline_errfunc(params,counts):
         eps = params['eps'].value
-        context_sgn = np.array([max(i,0) for i in df.context.apply(np.sign)])
-        choice = df.subj_ts
+        n_agree, n_disagree = counts
         #minimize
-        return -np.sum(np.log(abs(abs(choice - (1-context_sgn))-eps)))
+        return -(xlogy(n_agree, 1-eps) + xlogy(n_disagree, eps))
 
     #Fit bias model
     #attempt to simplify:
     fit_params = lmfit.Parameters()
     fit_params.add('eps', value = .1, min = 0, max = 1)
-    out = lmfit.minimize(midline_errfunc,fit_params, method = 'lbfgsb', kws= {'df': data})
+    out = minimize_fit(midline_errfunc, fit_params, {'counts': midline_counts(data)},
+                       init = init, n_restarts = n_restarts, rng = rng)
     if verbose:
         lmfit.report_fit(out)
     if return_out:
@@ -258,29 +714,25 @@ def fit_midline_model(data, verbose = True, return_out = False):
     else:
         return out.params.valuesdict()
     
-def fit_switch_model(data, verbose = True, return_out = False):
-    def switch_errfunc(params,df):
+def fit_switch_model(data, verbose = True, return_out = False, init = None, 
+                     n_restarts = 0, rng = None):
+    def switch_errfunc(params,counts):
         params = params.valuesdict()
         r1 = params['r1']
         r2 = params['r2']   
         eps = params['eps']
         model = SwitchModel(r1 = r1, r2 = r2, eps = eps)
-        model_likelihoods = []
-        model_likelihoods.append(.5)
-        for i in df.index[1:]:
-            last_choice = df.subj_ts[i-1]
-            trial_choice = df.subj_ts[i]
-            conf = model.calc_TS_prob(last_choice)
-            model_likelihoods.append(conf[trial_choice])
-            
-        # minimize
-        return abs(np.sum(np.log(model_likelihoods))) # single value
+        # probability of each choice given the last choice, indexed [last, choice]
+        conf = np.array([model.calc_TS_prob(last_choice) for last_choice in [0,1]])
+        # minimize, the first trial is scored at chance
+        return -(np.log(.5) + np.sum(xlogy(counts, conf))) # single value
     # Fit switch model
     fit_params = lmfit.Parameters()
     fit_params.add('r1', value=.5, min=0, max=1)
     fit_params.add('r2', value=.5, min=0, max=1)
     fit_params.add('eps', value = .1, min = 0, max = 1)
-    out = lmfit.minimize(switch_errfunc,fit_params, method = 'lbfgsb', kws= {'df': data})
+    out = minimize_fit(switch_errfunc, fit_params, {'counts': switch_counts(data)},
+                       init = init, n_restarts = n_restarts, rng = rng)
     if verbose:
         lmfit.report_fit(out)
     if return_out:
@@ -288,24 +740,12 @@ def fit_switch_model(data, verbose = True, return_out = False):
     else:
         return out.params.valuesdict()
 
-def fit_memory_model(train_ts_dis, data, k = None, perseverance = None, verbose = True, return_out = False):
+def fit_memory_model(train_ts_dis, data, k = None, perseverance = None, verbose = True, 
+                     return_out = False, init = None, n_restarts = 0, rng = None):
     def errfunc(params,df):
-        params = params.valuesdict()
-        k = params['k']
-        perseverance = params['perseverance']   
-        bias = params['bias']
-        TS_eps = params['TS_eps']
-        model = MemoryModel(train_ts_dis, k = k, perseverance = perseverance, bias = bias, TS_eps=TS_eps)
-        model_likelihoods = []
-        model_likelihoods.append(.5)
-        for i in df.index[1:]:
-            last_choice = df.subj_ts[i-1]
-            trial_choice = df.subj_ts[i]
-            c = df.context[i]
-            conf = model.calc_posterior(c, last_choice)
-            model_likelihoods.append(conf[trial_choice])
         # minimize
-        return abs(np.sum(np.log(np.array(model_likelihoods)))) # single value
+        return -np.sum(model_log_likelihoods('memory', params.valuesdict(), df, 
+                                             train_ts_dis)) # single value
     # Fit memory model
     fit_params = lmfit.Parameters()
     if k == None:
@@ -318,7 +758,8 @@ def fit_memory_model(train_ts_dis, data, k = None, perseverance = None, verbose
         fit_params.add('perseverance', value = perseverance, vary = False)
     fit_params.add('bias', value = .5, min = 0, max = 1)
     fit_params.add('TS_eps', value = .1, min = 0, max = 1)
-    out = lmfit.minimize(errfunc,fit_params, method = 'lbfgsb', kws= {'df': data})
+    out = minimize_fit(errfunc, fit_params, {'df': get_trial_data(data)},
+                       init = init, n_restarts = n_restarts, rng = rng)
     fit_params = out.params.valuesdict()
     if verbose:
         lmfit.report_fit(out)
@@ -327,16 +768,143 @@ def fit_memory_model(train_ts_dis, data, k = None, perseverance = None, verbose
     else:
         return fit_params
     
+#*********************************************
+# Model log likelihoods
+#*********************************************
+
+def get_model(model_name, params, ts_dis):
+    """
+    Model object for a model's parameters. The fixed-rp bias models can pass rp
+    in place of r1 and r2. The midline model has no class and returns None
+    """
+    if model_name in ['bias2', 'bias1', 'eoptimal', 'ignore']:
+        if 'rp' in params:
+            # passed as r1 and r2 since BiasPredModel ignores an rp of 0
+            return BiasPredModel(ts_dis, [.5,.5], params['rp'], params['rp'], 
+                                 TS_eps = params['TS_eps'])
+        return BiasPredModel(ts_dis, [.5,.5], params['r1'], params['r2'],
+                             TS_eps = params['TS_eps'])
+    elif model_name == 'switch':
+        return SwitchModel(params['r1'], params['r2'], params['eps'])
+    elif model_name in ['memory', 'perseverance', 'permem']:
+        return MemoryModel(ts_dis, k = params['k'], perseverance = params['perseverance'],
+                           bias = params['bias'], TS_eps = params['TS_eps'])
+
+def model_log_likelihoods(model_name, params, data, ts_dis):
+    """
+    Log probability of each trial's TS choice under a model, scored the same
+    way as the model's fitting function (the first trial of the switch and
+    memory models is at chance). Every model is run over the whole session at
+    once
+    :return: array (n_trials,)
+    """
+    data = get_trial_data(data)
+    choices = data.subj_ts
+    model = get_model(model_name, params, ts_dis)
+    if model_name in ['bias2', 'bias1', 'eoptimal', 'ignore']:
+        return model.calc_log_likelihoods(data.context, choices)
+    loglik = np.empty(len(choices))
+    with np.errstate(divide = 'ignore'):
+        if model_name == 'midline':
+            agree = choices == np.maximum(np.sign(data.context), 0)
+            loglik[:] = np.where(agree, np.log(1-params['eps']), np.log(params['eps']))
+        elif model_name == 'switch':
+            conf = np.array([model.calc_TS_prob(last_choice) for last_choice in [0,1]])
+            loglik[:1] = np.log(.5)
+            loglik[1:] = np.log(conf[choices[:-1], choices[1:]])
+        else:
+            TS_probs = model.calc_posteriors(data.context[1:], choices[:-1])
+            loglik[:1] = np.log(.5)
+            loglik[1:] = np.log(TS_probs[np.arange(len(choices)-1), choices[1:]])
+    return loglik
+
+#*********************************************
+# Parallel fitting
+#*********************************************
+
+def run_fit_task(task):
+    """
+    Run one independent fit. Errors are caught and returned rather than raised
+    so one failed fit doesn't stop the rest
+    :task: (key, fitting function, args, kwargs)
+    :return: (key, fit result or None, traceback string or None)
+    """
+    key, fun, args, kwargs = task
+    try:
+        return key, fun(*args, **kwargs), None
+    except Exception:
+        return key, None, traceback.format_exc()
+
+def _bounded_imap(pool, fun, tasks, max_pending):
+    """
+    pool.imap that submits a task only when fewer than max_pending tasks are
+    running or waiting to be yielded, so results that finish ahead of an 
+    earlier task can't pile up
+    """
+    tasks = iter(tasks)
+    pending = collections.deque(pool.apply_async(fun, (task,)) 
+                                for task in itertools.islice(tasks, max_pending))
+    while pending:
+        result = pending.popleft().get()
+        pending.extend(pool.apply_async(fun, (task,)) for task in itertools.islice(tasks, 1))
+        yield result
+
+def iter_fit_tasks(tasks, jobs = 1, verbose = True, max_pending = None):
+    """
+    Generator version of run_fit_tasks. Yields each task's result as soon as it
+    and every task before it have finished, so results come out in task order
+    whatever order the workers finish in and can be written out as they arrive
+    :max_pending: most tasks to have running or finished but not yet yielded,
+        which bounds the memory held by results. Default no limit
+    """
+    tasks = list(tasks)
+    if jobs > 1 and len(tasks) > 1:
+        # fork so workers don't re-import the analysis scripts, which run on import
+        pool = multiprocessing.get_context('fork').Pool(min(jobs, len(tasks)))
+        try:
+            if max_pending is None:
+                results = pool.imap(run_fit_task, tasks, chunksize = 1)
+            else:
+                results = _bounded_imap(pool, run_fit_task, tasks, max(max_pending, jobs))
+            for i, result in enumerate(results):
+                if verbose:
+                    print('Finished fit %s of %s: %s' % (i+1, len(tasks), result[0]))
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for task in tasks:
+            yield run_fit_task(task)
+
+def run_fit_tasks(tasks, jobs = 1, verbose = True):
+    """
+    Run a list of fit tasks (see run_fit_task), in a pool of jobs processes if
+    jobs > 1. Results are returned in task order whatever order the workers
+    finish in, so merging them is deterministic
+    :return: list of (key, fit result or None, traceback string or None)
+    """
+    tasks = list(tasks)
+    results = list(iter_fit_tasks(tasks, jobs, verbose))
+    failed = [(key, error) for key, result, error in results if error is not None]
+    if failed:
+        print('\n%s of %s fits failed:' % (len(failed), len(tasks)))
+        for key, error in failed:
+            print(key)
+            print(error)
+    return results
     
 #*********************************************
 # Generate Model Predtions
 #*********************************************
 
-def gen_bias_TS_posteriors(models, data, model_names = None, model_type = 'TS', reduce = True, get_choice = False, postfix = ''):
-    """ Generates an array of TS or model(s)
-    :model: model or array of models that has a calc_posterior method
-    :data: dataframe with a context
-    :reduce: bool, if True only show the posterior for task-set 2
+def _gen_TS_posteriors(models, data, model_names, model_type, reduce, get_choice, 
+                       postfix, calc_TS_probs, rng):
+    """
+    Shared by gen_bias_TS_posteriors and gen_memory_TS_posteriors. Each model
+    is run over the whole session at once with calc_TS_probs(model, trials),
+    which returns its (n_trials, 2) TS probabilities, and all of the new
+    columns are added to data in one assignment
     """
     assert len(model_names)
     if not isinstance(models,list):
@@ -346,73 +914,59 @@ def gen_bias_TS_posteriors(models, data, model_names = None, model_type = 'TS',
             model_names = [model_names]
         assert len(model_names) == len(models), \
             'Model_names must be the same length as models'
-    model_posteriors = [[] for _ in  range(len(models))]
-    model_choices = [[] for _ in  range(len(models))]
-    for i,trial in data.iterrows():
-        c = trial.context
-        s = trial.stim
-        for j,model in enumerate(models):
-            if model_type == 'TS':
-                posterior = model.calc_posterior(c)
-            elif model_type == 'action':
-                posterior = model.calc_action_posterior(s,c)
-            if reduce:
-                model_posteriors[j].append(posterior[1])
-            else:
-                model_posteriors[j].append(posterior)
-            if get_choice:
-                model_choices[j].append([model.choose() for _ in range(10)])
-    for j,posteriors in enumerate(model_posteriors):
-        if model_names:
-            model_name = model_names[j]
+    else:
+        model_names = ['model_%s' % j for j in range(len(models))]
+    if rng is None:
+        rng = np.random
+    trials = get_trial_data(data)
+    columns = {}
+    for model_name, model in zip(model_names, models):
+        TS_probs = calc_TS_probs(model, trials)
+        if model_type == 'TS':
+            posteriors = TS_probs
+        elif model_type == 'action':
+            posteriors = action_probabilities(TS_probs, trials.stim, model.action_eps)
+        if reduce:
+            columns[model_name + '_posterior' + postfix] = posteriors[:,1]
         else:
-            model_name = 'model_%s' % j
-        data[model_name + '_posterior' + postfix] = model_posteriors[j]
+            columns[model_name + '_posterior' + postfix] = pd.Series(list(posteriors), index = data.index)
         if get_choice:
-            data[model_name + '_choices' + postfix] = model_choices[j]
-        
+            # 10 TS choices per trial from the models' default (e-greedy) choose
+            # rule, whose probabilities are the TS probabilities. Trials without
+            # a posterior are at chance
+            p_TS2 = np.nan_to_num(TS_probs[:,1], nan = .5)
+            choices = (rng.random_sample((len(trials), 10)) < p_TS2[:,np.newaxis]).astype(int)
+            columns[model_name + '_choices' + postfix] = pd.Series(choices.tolist(), index = data.index)
+    columns = pd.DataFrame(columns, index = data.index)
+    data[list(columns.columns)] = columns
 
-def gen_memory_TS_posteriors(models, data, model_names = None, model_type = 'TS', reduce = True, get_choice = False, postfix = ''):
+def gen_bias_TS_posteriors(models, data, model_names = None, model_type = 'TS', reduce = True, 
+                           get_choice = False, postfix = '', rng = None):
     """ Generates an array of TS or model(s)
-    :model: model or array of models that has a calc_posterior method
+    :model: model or array of models that has a calc_posteriors method
     :data: dataframe with a context
     :reduce: bool, if True only show the posterior for task-set 2
+    :rng: RandomState for the sampled choices. None uses the global numpy state
     """
-    assert len(model_names)
-    if not isinstance(models,list):
-        models = [models]
-    if model_names:
-        if not isinstance(model_names,list):
-            model_names = [model_names]
-        assert len(model_names) == len(models), \
-            'Model_names must be the same length as models'
-    model_posteriors = [[] for _ in  range(len(models))]
-    model_choices = [[] for _ in  range(len(models))]
-    last_choice = None
-    for i,trial in data.iterrows():
-        c = trial.context
-        s = trial.stim
-        for j,model in enumerate(models):
-            if model_type == 'TS':
-                posterior = model.calc_posterior(c, last_choice)
-            elif model_type == 'action':
-                posterior = model.calc_action_posterior(s,c)
-            if reduce:
-                model_posteriors[j].append(posterior[1])
-            else:
-                model_posteriors[j].append(posterior)
-            if get_choice:
-                model_choices[j].append([model.choose() for _ in range(10)])
-        last_choice = trial.subj_ts
-            
-    for j,posteriors in enumerate(model_posteriors):
-        if model_names:
-            model_name = model_names[j]
-        else:
-            model_name = 'model_%s' % j
-        data[model_name + '_posterior' + postfix] = model_posteriors[j]
-        if get_choice:
-            data[model_name + '_choices' + postfix] = model_choices[j]
+    calc_TS_probs = lambda model, trials: model.calc_posteriors(trials.context)
+    _gen_TS_posteriors(models, data, model_names, model_type, reduce, get_choice, postfix,
+                       calc_TS_probs, rng)
+
+def gen_memory_TS_posteriors(models, data, model_names = None, model_type = 'TS', reduce = True, 
+                             get_choice = False, postfix = '', rng = None):
+    """ Generates an array of TS or model(s)
+    :model: model or array of models that has a calc_posteriors method
+    :data: dataframe with a context
+    :reduce: bool, if True only show the posterior for task-set 2
+    :rng: RandomState for the sampled choices. None uses the global numpy state
+    """
+    def calc_TS_probs(model, trials):
+        # there is no last choice on the first trial, so it has no posterior
+        TS_probs = np.full((len(trials), 2), np.nan)
+        TS_probs[1:] = model.calc_posteriors(trials.context[1:], trials.subj_ts[:-1])
+        return TS_probs
+    _gen_TS_posteriors(models, data, model_names, model_type, reduce, get_choice, postfix,
+                       calc_TS_probs, rng)
         
 #*********************************************
 # Plotting
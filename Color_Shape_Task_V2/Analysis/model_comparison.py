@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Per-trial log likelihoods of the fitted models and cross-validated model
+comparison.
+
+Log likelihoods are stored as one float32 array indexed (subject, model, trial)
+in a .npy file that can be memory mapped, with the subject and model names and
+each subject's number of trials in a json file next to it. Subjects with fewer
+trials are padded with NaN.
+
+The fits are point estimates, so there are no posterior draws to importance
+sample for PSIS-LOO. Models are instead compared on the log likelihood of held-out
+trials (each cross-validation block scored with the parameters fit without it),
+with standard errors from contiguous blocks of trials.
+"""
+
+import json
+import os
+import numpy as np
+import pandas as pd
+from helper_functions import model_log_likelihoods
+
+def write_log_likelihoods(path, logliks, subjects, models):
+    """
+    Write per-trial log likelihoods to path.npy (float32) and path.json.
+    Both are written to temporary files first and moved into place, so an
+    interrupted write leaves the previous store
+    :logliks: dict of (subject, model) -> array of the subject's trials
+    :return: the written array, memory mapped
+    """
+    n_trials = [max(len(logliks[(subj, model)]) for model in models) for subj in subjects]
+    out = np.lib.format.open_memmap(path + '.tmp.npy', mode = 'w+', dtype = np.float32,
+                                    shape = (len(subjects), len(models), max(n_trials + [0])))
+    out[:] = np.nan
+    for s, subj in enumerate(subjects):
+        for m, model in enumerate(models):
+            loglik = logliks[(subj, model)]
+            out[s, m, :len(loglik)] = loglik
+    out.flush()
+    with open(path + '.tmp.json', 'w') as f:
+        json.dump({'subjects': list(subjects), 'models': list(models),
+                   'n_trials': n_trials}, f)
+    os.replace(path + '.tmp.npy', path + '.npy')
+    os.replace(path + '.tmp.json', path + '.json')
+    return out
+
+def read_log_likelihoods(path, mmap_mode = 'r'):
+    """
+    Read log likelihoods written by write_log_likelihoods
+    :return: array (subjects, models, trials) and dict with the subject and
+        model names and each subject's number of trials
+    """
+    with open(path + '.json') as f:
+        index = json.load(f)
+    return np.load(path + '.npy', mmap_mode = mmap_mode), index
+
+def read_log_likelihood_dict(path, subjects = None):
+    """
+    Read log likelihoods written by write_log_likelihoods back into the dict it
+    takes, so subjects can be added to a store without recomputing the rest
+    :subjects: subjects to read, default all of them. Subjects that aren't in
+        the store are left out
+    :return: dict of (subject, model) -> array of the subject's trials
+    """
+    logliks, index = read_log_likelihoods(path)
+    logliks_dict = {}
+    for s, subj in enumerate(index['subjects']):
+        if subjects is None or subj in subjects:
+            for m, model in enumerate(index['models']):
+                logliks_dict[(subj, model)] = np.array(logliks[s, m, :index['n_trials'][s]])
+    return logliks_dict
+
+def subject_log_likelihoods(model_names, fit_dict_key, model_dicts, data, ts_dis,
+                            splits = None):
+    """
+    Per-trial log likelihoods of one subject's data under each model's fits.
+    :fit_dict_key: function giving the fit_dict key of a split, e.g.
+        lambda p: subj_name + '_TS' + p
+    :splits: list of (split, trial slice) pairs. Each split's fit scores only
+        the trials in its slice (the model is still run over the whole session
+        so its state carries over), giving held-out log likelihoods. If None
+        the '_fullRun' fit scores every trial
+    :return: dict of model name -> array (n_trials,)
+    """
+    if splits is None:
+        splits = [('_fullRun', slice(None))]
+    logliks = {}
+    for name in model_names:
+        loglik = np.full(len(data), np.nan)
+        for split, trials in splits:
+            params = model_dicts[name]['fit_dict'][fit_dict_key(split)]
+            loglik[trials] = model_log_likelihoods(name, params, data, ts_dis)[trials]
+        logliks[name] = loglik
+    return logliks
+
+def block_sums(logliks, n_trials, n_blocks = 10):
+    """
+    Sum each subject's trials in n_blocks contiguous blocks
+    :logliks: array (subjects, models, trials)
+    :return: array (subjects*n_blocks, models)
+    """
+    sums = []
+    for s, n in enumerate(n_trials):
+        for block in np.array_split(np.arange(n), n_blocks):
+            sums.append(np.sum(logliks[s][:, block], 1, dtype = float))
+    return np.array(sums)
+
+def compare_elpd(logliks, index, n_blocks = 10):
+    """
+    Compare models by expected log predictive density (the summed held-out log
+    likelihood). Standard errors treat contiguous blocks of trials as the
+    independent units, since trials within a block share the model's state
+    :return: dataframe indexed by model, sorted best first, with elpd, its
+        standard error, and the difference from the best model and its standard
+        error
+    """
+    sums = block_sums(logliks, index['n_trials'], n_blocks)
+    n = len(sums)
+    elpd = sums.sum(0)
+    best = np.argmax(elpd)
+    diffs = sums - sums[:, best:best+1]
+    comparison = pd.DataFrame({'elpd': elpd,
+                               'se': np.sqrt(n*np.var(sums, 0, ddof = 1)),
+                               'elpd_diff': diffs.sum(0),
+                               'diff_se': np.sqrt(n*np.var(diffs, 0, ddof = 1))},
+                              index = index['models'])
+    return comparison.sort_values('elpd', ascending = False)
+
+def subject_elpd(logliks, index):
+    """
+    Each subject's summed log likelihood under each model
+    :return: dataframe indexed by subject with a column per model
+    """
+    return pd.DataFrame(np.nansum(logliks, 2, dtype = float), index = index['subjects'],
+                        columns = index['models'])
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter and model recovery for the models in helper_classes.
+
+Each point simulates a dataset from one model with randomly drawn parameters.
+Parameter recovery refits that model to it; model recovery fits every model to
+it and compares them by BIC. Points get independent random streams spawned
+from one seed, so a run gives the same output whatever number of processes it
+is spread over. Results are appended to a csv file in point order as they
+finish, and an interrupted run picks up after the last point written.
+"""
+
+import csv, io, os
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+from helper_functions import fit_bias2_model, fit_bias1_model, fit_static_model, \
+    fit_switch_model, fit_midline_model, fit_memory_model, genSeqs, \
+    sampleContexts, simulateModels, iter_fit_tasks, fit_bias_family, \
+    model_log_likelihoods
+
+# fitting function, fixed arguments and free parameters (with the range they
+# are drawn from when simulating) of each model. A fixed rp of None is filled
+# in with the task's recursive probability
+model_specs = {
+    'bias2': {'fitting_fun': fit_bias2_model, 'fixed': {},
+              'free': {'r1': (0,1), 'r2': (0,1), 'TS_eps': (0,1)}},
+    'bias1': {'fitting_fun': fit_bias1_model, 'fixed': {},
+              'free': {'rp': (0,1), 'TS_eps': (0,1)}},
+    'eoptimal': {'fitting_fun': fit_static_model, 'fixed': {'rp': None},
+                 'free': {'TS_eps': (0,1)}},
+    'ignore': {'fitting_fun': fit_static_model, 'fixed': {'rp': .5},
+               'free': {'TS_eps': (0,1)}},
+    'midline': {'fitting_fun': fit_midline_model, 'fixed': {},
+                'free': {'eps': (0,1)}},
+    'switch': {'fitting_fun': fit_switch_model, 'fixed': {},
+               'free': {'r1': (0,1), 'r2': (0,1), 'eps': (0,1)}},
+    'memory': {'fitting_fun': fit_memory_model, 'fixed': {'perseverance': 0},
+               'free': {'k': (0,2), 'bias': (0,1), 'TS_eps': (0,1)}},
+    'perseverance': {'fitting_fun': fit_memory_model, 'fixed': {'k': 0},
+                     'free': {'perseverance': (0,1), 'bias': (0,1), 'TS_eps': (0,1)}},
+    'permem': {'fitting_fun': fit_memory_model, 'fixed': {},
+               'free': {'k': (0,2), 'perseverance': (0,1), 'bias': (0,1),
+                        'TS_eps': (0,1)}},
+}
+model_names = list(model_specs.keys())
+
+def get_model_params(model_name, free_params, rp = .9):
+    """
+    Combine a model's free parameters with its fixed ones
+    """
+    params = dict(model_specs[model_name]['fixed'])
+    if 'rp' in params and params['rp'] is None:
+        params['rp'] = rp
+    params.update(free_params)
+    return params
+
+def sample_params(model_name, rng):
+    """
+    Draw a model's free parameters uniformly from their ranges
+    """
+    free = model_specs[model_name]['free']
+    return {name: rng.uniform(low, high) for name, (low, high) in free.items()}
+
+def simulate_data(model_name, params, ts_dis, n = 800, p = .9, rng = None):
+    """
+    Simulate n trials of TS choices from a model with simulateModels. Choices
+    are sampled from the same TS probabilities the model is fit with, so the
+    first trial of the switch and memory models (which depend on the last
+    choice) is at chance
+    :params: all of the model's parameters (see get_model_params)
+    :rng: RandomState. None uses the global numpy state
+    :return: dataframe with context, ts and subj_ts columns
+    """
+    if model_name == 'midline':
+        if rng is None:
+            rng = np.random
+        # contexts <= 0 predict TS1
+        seq = genSeqs(n, p, rng = rng)[0]
+        contexts = sampleContexts(seq, ts_dis, random_state = rng)
+        draws = rng.random_sample(n)
+        eps = params['eps']
+        choices = (draws < np.where(contexts > 0, 1-eps, eps)).astype(int)
+        return pd.DataFrame({'context': contexts, 'ts': seq, 'subj_ts': choices})
+    if model_name in ['bias2', 'bias1', 'eoptimal', 'ignore']:
+        model_type = 'bias'
+        params = {'r1': params.get('r1', params.get('rp')), 
+                  'r2': params.get('r2', params.get('rp')), 'TS_eps': params['TS_eps']}
+    elif model_name == 'switch':
+        model_type = 'switch'
+    else:
+        model_type = 'memory'
+    # simulateModels runs n-1 trials, like simulateModel
+    sim = simulateModels([params], ts_dis, model_name, n+1, p, rng = rng, 
+                         model_type = model_type)
+    return sim[['context', 'ts', 'subj_ts']]
+
+def model_nll(model_name, params, data, ts_dis):
+    """
+    Negative log likelihood of the TS choices in data under a model
+    """
+    return -np.sum(model_log_likelihoods(model_name, params, data, ts_dis))
+
+def fit_data(model_name, data, ts_dis, rp = .9, n_restarts = 0, rng = None):
+    """
+    Fit a model to data with its fitting function from model_specs
+    :return: dict of fitted parameters
+    """
+    spec = model_specs[model_name]
+    kwargs = get_model_params(model_name, {}, rp)
+    if model_name in ['bias2', 'bias1', 'eoptimal', 'ignore']:
+        kwargs.update({'action_eps': 0, 'model_type': 'TS'})
+    if model_name in ['midline', 'switch']:
+        args = (data,)
+    else:
+        args = (ts_dis, data)
+    return spec['fitting_fun'](*args, verbose = False, n_restarts = n_restarts,
+                               rng = rng, **kwargs)
+
+def simulate_point(model_name, seed, ts_dis, n = 800, p = .9, rp = .9):
+    """
+    Draw a model's parameters and simulate a dataset from its point's stream
+    :seed: SeedSequence for the point's random stream
+    :return: the free parameters, the dataset and the stream, which is then
+        used for the fits' random restarts
+    """
+    rng = np.random.RandomState(np.random.MT19937(seed))
+    true_params = sample_params(model_name, rng)
+    data = simulate_data(model_name, get_model_params(model_name, true_params, rp),
+                         ts_dis, n, p, rng)
+    return true_params, data, rng
+
+def recover_point(model_name, seed, ts_dis, n = 800, p = .9, rp = .9, n_restarts = 0):
+    """
+    One parameter recovery point: simulate a dataset and refit the model
+    :return: list of (param, true value, recovered value)
+    """
+    true_params, data, rng = simulate_point(model_name, seed, ts_dis, n, p, rp)
+    fit = fit_data(model_name, data, ts_dis, rp, n_restarts, rng)
+    return [(name, value, fit[name]) for name, value in true_params.items()]
+
+def compare_point(model_name, seed, ts_dis, n = 800, p = .9, rp = .9, n_restarts = 0,
+                  fit_models = model_names):
+    """
+    One model recovery point: simulate a dataset from model_name (the same
+    dataset recover_point uses) and fit every model in fit_models to it. The
+    bias models are fit together with fit_bias_family when all four are used
+    :return: list of (fit model, nll, BIC)
+    """
+    _, data, rng = simulate_point(model_name, seed, ts_dis, n, p, rp)
+    fits = {}
+    if all(name in fit_models for name in ['bias2', 'bias1', 'eoptimal', 'ignore']):
+        fits = fit_bias_family(ts_dis, data, rp, action_eps = 0, model_type = 'TS', 
+                               verbose = False, n_restarts = n_restarts, rng = rng)
+    rows = []
+    for fit_model in fit_models:
+        if fit_model in fits:
+            fit = fits[fit_model]
+        else:
+            fit = fit_data(fit_model, data, ts_dis, rp, n_restarts, rng)
+        nll = model_nll(fit_model, get_model_params(fit_model, fit, rp), data, ts_dis)
+        n_params = len(model_specs[fit_model]['free'])
+        rows.append((fit_model, nll, 2*nll + n_params*np.log(len(data))))
+    return rows
+
+#*********************************************
+# Running points
+#*********************************************
+
+def _complete_lines(out_file, header, n_rows):
+    """
+    Lines of a results file that belong to points whose rows were all written
+    (a killed run can leave a point, or its last line, half written)
+    :n_rows: function giving the number of rows a model's points have
+    """
+    if not os.path.exists(out_file):
+        return [header]
+    with open(out_file) as f:
+        lines = f.readlines()
+    if lines and not lines[-1].endswith('\n'):
+        lines = lines[:-1]
+    counts = {}
+    for line in lines[1:]:
+        point = tuple(line.split(',')[:2])
+        counts[point] = counts.get(point, 0) + 1
+    complete = lambda point: point[0] in model_specs and counts[point] == n_rows(point[0])
+    return [header] + [line for line in lines[1:] if complete(tuple(line.split(',')[:2]))]
+
+def _run_points(out_file, header, n_rows, point_fun, model_names, n_points, seed,
+                args, jobs = 1, verbose = True):
+    """
+    Run point_fun(model_name, seed, *args) for n_points points of each model,
+    in a pool of jobs processes if jobs > 1, and append the rows it returns to
+    out_file (prefixed by model name and point) as they finish. Every point's
+    random stream is spawned from seed by its (model, point) index, so adding
+    points or models doesn't change the existing ones. Points that are already
+    in out_file are skipped, so rerunning with the same arguments resumes an
+    interrupted run
+    """
+    # rewrite the complete points first in case the last run was killed mid-write
+    lines = _complete_lines(out_file, header, n_rows)
+    with open(out_file, 'w') as f:
+        f.writelines(lines)
+    done = set(tuple(line.split(',')[:2]) for line in lines[1:])
+    tasks = []
+    for name in model_names:
+        m = list(model_specs.keys()).index(name)
+        for point in range(n_points):
+            if (name, str(point)) not in done:
+                # the same stream root.spawn() would give the point's child
+                point_seed = np.random.SeedSequence(seed, spawn_key = (m, point))
+                tasks.append(((name, point), point_fun, (name, point_seed) + tuple(args), {}))
+    # lines end in \n like the header and the lines rewritten above
+    with open(out_file, 'a', newline = '') as f:
+        writer = csv.writer(f, lineterminator = '\n')
+        for (name, point), rows, error in iter_fit_tasks(tasks, jobs, verbose):
+            if error is not None:
+                print('Point %s %s failed:\n%s' % (name, point, error))
+                continue
+            writer.writerows([(name, point) + tuple(repr(float(value)) if
+                              isinstance(value, (float, np.floating)) else value
+                              for value in row) for row in rows])
+            f.flush()
+    return pd.read_csv(io.StringIO(''.join(_complete_lines(out_file, header, n_rows))))
+
+recovery_header = 'model,point,param,true,recovered\n'
+comparison_header = 'model,point,fit_model,nll,BIC\n'
+
+def read_recovery(out_file):
+    """
+    Read a results file written by run_recovery, leaving out incomplete points
+    """
+    n_rows = lambda name: len(model_specs[name]['free'])
+    return pd.read_csv(io.StringIO(''.join(_complete_lines(out_file, recovery_header, n_rows))))
+
+def run_recovery(out_file, model_names = model_names, n_points = 100, seed = 0,
+                 ts_dis = [norm(-.3,.37), norm(.3,.37)], n = 800, p = .9, rp = .9,
+                 n_restarts = 0, jobs = 1, verbose = True):
+    """
+    Parameter recovery: n_points points for each model, each refitting the
+    model to a dataset simulated from it. See _run_points for how points are
+    run, written and resumed
+    :return: long-format dataframe with one row per model, point and parameter
+    """
+    n_rows = lambda name: len(model_specs[name]['free'])
+    return _run_points(out_file, recovery_header, n_rows, recover_point, model_names,
+                       n_points, seed, (ts_dis, n, p, rp, n_restarts), jobs, verbose)
+
+def run_model_comparison(out_file, model_names = model_names, n_points = 100, seed = 0,
+                         ts_dis = [norm(-.3,.37), norm(.3,.37)], n = 800, p = .9,
+                         rp = .9, n_restarts = 0, fit_models = model_names,
+                         jobs = 1, verbose = True):
+    """
+    Model recovery: n_points points for each model in model_names, each fitting
+    every model in fit_models to a dataset simulated from it. Points with the
+    same seed use the same datasets as run_recovery. See _run_points for how
+    points are run, written and resumed
+    :return: long-format dataframe with one row per model, point and fit model
+    """
+    fit_models = list(fit_models)
+    n_rows = lambda name: len(fit_models)
+    return _run_points(out_file, comparison_header, n_rows, compare_point, model_names,
+                       n_points, seed, (ts_dis, n, p, rp, n_restarts, fit_models),
+                       jobs, verbose)
+
+def confusion_matrix(comparison):
+    """
+    Fraction of each model's datasets that each fit model wins by BIC
+    :comparison: results from run_model_comparison
+    :return: dataframe indexed by generating model with a column per fit model
+    """
+    best = comparison.loc[comparison.groupby(['model', 'point'])['BIC'].idxmin()]
+    models = [name for name in model_names if name in set(comparison['fit_model'])]
+    confusion = pd.crosstab(best['model'], best['fit_model'], normalize = 'index')
+    return confusion.reindex(columns = models, fill_value = 0)
+
+def bic_margins(comparison):
+    """
+    BIC of the best model other than the generating one minus the generating
+    model's BIC for each dataset. Positive margins mean the generating model
+    was recovered, and their size says by how much
+    :return: dataframe with model, point, the best other model and the margin
+    """
+    own = comparison['fit_model'] == comparison['model']
+    own_bic = comparison[own].set_index(['model', 'point'])['BIC']
+    others = comparison[~own]
+    best_other = others.loc[others.groupby(['model', 'point'])['BIC'].idxmin()]
+    best_other = best_other.set_index(['model', 'point'])
+    return pd.DataFrame({'best_other': best_other['fit_model'],
+                         'margin': best_other['BIC'] - own_bic}).reset_index()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Observer models computed for a whole session at once.
+
+Each observer takes the session's columns as arrays and returns one value per
+trial. Parameters can be scalars or per-trial arrays, so the cross-validated
+columns are made by indexing each fold's parameters by the fold that held out
+each trial.
+"""
+
+import numpy as np
+from helper_classes import get_likelihoods
+
+def optimal_observer(contexts, ts, ts_dis, recursive_p = .9):
+    """
+    Ideal observer of the train phase. It knows the task statistics and learns
+    the TS from feedback, so its prior on each trial is the transition
+    probability from the previous trial's true TS (.5 on the first trial)
+    :contexts: (n,) contexts
+    :ts: (n,) true TS of each trial
+    :return: (n,) posterior probability of TS2
+    """
+    ts = np.asarray(ts)
+    prior = np.empty(len(ts))
+    prior[:1] = .5
+    prior[1:] = np.where(ts[:-1] == 1, recursive_p, 1-recursive_p).round(2)
+    likelihood = get_likelihoods(ts_dis, contexts)
+    numer = likelihood[:,1]*prior
+    return numer/(likelihood[:,0]*(1-prior) + numer)
+
+def midline_observer(contexts, eps):
+    """
+    Observer that picks TS2 for contexts above the midline and TS1 otherwise,
+    guessing randomly with probability eps
+    :return: (n,) probability of TS2
+    """
+    side = np.maximum(0, np.sign(contexts))
+    return abs(side - eps)
+
+def switch_observer(choices, r1, r2, eps):
+    """
+    Observer that only knows the last TS chosen and the probabilities of
+    staying with each TS (SwitchModel)
+    :choices: (n,) TS choices
+    :return: (n,) probability of each trial's choice. The first trial, with
+        no last choice, is .5
+    """
+    choices = np.asarray(choices, dtype = int)
+    r1, r2, eps = [np.broadcast_to(np.asarray(param, dtype = float), choices.shape)[1:]
+                   for param in (r1, r2, eps)]
+    last_choices = choices[:-1]
+    stay = np.where(last_choices == 0, r1, r2)
+    probs = np.empty(len(choices))
+    probs[:1] = .5
+    probs[1:] = (1-eps)*np.where(choices[1:] == last_choices, stay, 1-stay) + eps/2
+    return probs
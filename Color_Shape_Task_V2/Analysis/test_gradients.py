@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Check the analytic gradients of the bias-model objectives against central
+finite differences, at interior points and near the parameter bounds.
+
+Run from the Analysis directory with: python -m pytest test_gradients.py
+"""
+
+import numpy as np
+import pytest
+from scipy.stats import norm
+from helper_functions import TrialData, bias_nll_grad, static_objective, sampleContexts
+
+ts_dis = [norm(-.3,.37), norm(.3,.37)]
+step = 1e-6
+# (r1, r2, TS_eps). The r and TS_eps bounds are [0, 1]
+interior_points = [(.5, .5, .1), (.9, .3, .25), (.2, .8, .6)]
+bound_points = [(1e-3, .5, .1), (.999, .999, .05), (.5, 1e-3, .999), (.7, .4, 1e-3)]
+
+def make_data(n = 300, seed = 0):
+    rng = np.random.RandomState(seed)
+    # contexts as the task samples them, so they are looked up in the
+    # likelihood table like real data
+    context = sampleContexts(rng.randint(0, 2, n), ts_dis, random_state = rng)
+    subj_ts = rng.randint(0, 2, n)
+    stim = np.column_stack([rng.randint(0, 2, n), rng.randint(2, 4, n)])
+    response = stim[np.arange(n), subj_ts]
+    # some responses that match neither TS's action
+    response[rng.random_sample(n) < .05] = 4
+    return TrialData(context, subj_ts, stim, response)
+
+def central_difference(f, x, i):
+    dx = np.zeros(len(x))
+    dx[i] = step
+    return (f(x + dx) - f(x - dx))/(2*step)
+
+@pytest.mark.parametrize('model_type, action_eps', [('TS', 0), ('action', .1)])
+@pytest.mark.parametrize('point', interior_points + bound_points)
+def test_bias2_gradient(point, model_type, action_eps):
+    data = make_data()
+    nll = lambda x: bias_nll_grad(ts_dis, data, *x, action_eps = action_eps,
+                                  model_type = model_type)[0]
+    _, grad = bias_nll_grad(ts_dis, data, *point, action_eps = action_eps,
+                            model_type = model_type)
+    numeric = [central_difference(nll, np.array(point), i) for i in range(3)]
+    np.testing.assert_allclose(grad, numeric, rtol = 1e-5, atol = 1e-4)
+
+@pytest.mark.parametrize('point', interior_points + bound_points)
+def test_bias1_gradient(point):
+    # fit_bias1_model moves r1 and r2 together, so its gradient is the sum of theirs
+    data = make_data()
+    rp, _, TS_eps = point
+    nll = lambda x: bias_nll_grad(ts_dis, data, x[0], x[0], x[1])[0]
+    _, grad = bias_nll_grad(ts_dis, data, rp, rp, TS_eps)
+    numeric = [central_difference(nll, np.array([rp, TS_eps]), i) for i in range(2)]
+    np.testing.assert_allclose([grad[0]+grad[1], grad[2]], numeric, rtol = 1e-5, atol = 1e-4)
+
+@pytest.mark.parametrize('rp', [.5, .9])
+@pytest.mark.parametrize('TS_eps', [1e-3, .1, .5, .999])
+def test_static_gradient(rp, TS_eps):
+    data = make_data()
+    objective = static_objective(ts_dis, data, rp)
+    nll, grad = objective(TS_eps)
+    numeric = central_difference(lambda x: objective(x[0])[0], np.array([TS_eps]), 0)
+    np.testing.assert_allclose(grad, numeric, rtol = 1e-5, atol = 1e-4)
+    # and the same objective as the general bias model with r1 = r2 = rp
+    np.testing.assert_allclose(nll, bias_nll_grad(ts_dis, data, rp, rp, TS_eps)[0])
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the contexts the task produces are looked up in the cached
+likelihood table, and that the table gives the same likelihoods as the
+distributions.
+
+Run from the Analysis directory with: python -m pytest test_likelihoods.py
+"""
+
+import glob
+import numpy as np
+import pytest
+from scipy.stats import norm, beta
+from Load_Data import yaml_load
+from helper_classes import context_bins, get_likelihoods
+from helper_functions import sampleContexts
+
+ts_dis = [norm(-.3,.37), norm(.3,.37)]
+
+def config_contexts():
+    contexts = []
+    for filey in glob.glob('../Config_Files/*.yaml'):
+        with open(filey) as f:
+            contexts += [trial['context'] for trial in yaml_load(f)[1:]]
+    return np.array(contexts)
+
+def test_config_contexts_in_table():
+    contexts = config_contexts()
+    assert len(contexts)
+    assert np.isin(contexts, context_bins).all()
+
+@pytest.mark.parametrize('dists', [ts_dis, [beta(3, 23, loc = -1, scale = 2),
+                                            beta(23, 3, loc = -1, scale = 2)]])
+def test_sampled_contexts_in_table(dists):
+    states = np.random.RandomState(0).randint(0, 2, 2000)
+    contexts = sampleContexts(states, dists, random_state = 0)
+    assert np.isin(contexts, context_bins).all()
+
+def test_likelihoods_match_distributions():
+    contexts = np.concatenate([config_contexts(), context_bins, [-.95, 0, .42, 1.3]])
+    expected = np.array([dis.pdf(contexts) for dis in ts_dis]).T
+    np.testing.assert_allclose(get_likelihoods(ts_dis, contexts), expected)
+    np.testing.assert_allclose(get_likelihoods(ts_dis, contexts[0]), expected[0])
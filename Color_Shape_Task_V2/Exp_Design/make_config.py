@@ -12,6 +12,7 @@ from os import path
 import random as r
 from scipy.stats import norm
 from scipy.stats import beta
+from util import genSeqs, sampleContexts
 
 class ConfigList(object):
     """ 
@@ -162,23 +163,11 @@ class ConfigList(object):
         """
         if self.seed is not None:
             np.random.seed(self.seed)
-        trans_probs = np.matrix([[self.rp, 1-self.rp], [1-self.rp, self.rp]])
-        trial_states = [1] #start off the function
         #creates the task-set trial list. Task-sets alternate based on recusive_p
         #with a maximum repetition of 25 trials. This function also makes sure
         #that each task-set composes at least 40% of trials
-        while abs(np.mean(trial_states)-.5) > .1:
-            curr_state = r.choice(list(self.states.keys()))
-            trial_states = []
-            state_reps = 0
-            for trial in range(self.exp_len):
-                trial_states.append(curr_state)
-                if r.random() > trans_probs[curr_state,curr_state] or state_reps > 25:
-                    curr_state = 1-curr_state
-                    state_reps = 0
-                else:
-                    state_reps += 1
-        self.trial_states = trial_states
+        trial_states = genSeqs(self.exp_len, self.rp, max_reps = 25, balance = .1)
+        self.trial_states = trial_states[0].tolist()
             
                     
     def setup_trial_list(self, stimulusDuration=1.5, FBDuration=.5, 
@@ -201,19 +190,17 @@ class ConfigList(object):
         curr_onset = 2 #initial onset time
         stims = r.sample(self.stim_ids*int(self.exp_len/4.0),self.exp_len)   
             
-        #define bins. Will set context to center point of each bin
-        bin_boundaries = np.linspace(-1,1,11)
-        
+        #select snap positions from each state's distribution and fix them to 
+        #one of 11 points (center point of each bin)
+        dists = {key: self.distribution(**state['dist_args']) 
+                 for key, state in self.states.items()}
+        contexts = sampleContexts(self.trial_states, dists)
         
         for trial in range(self.exp_len):
             #add random amount to ITI
             ITI = base_ITI + r.random()*.5
             state = self.states[self.trial_states[trial]]
-            #print(state['dist_args'], state['dist_args'] is None)
-            dist = self.distribution(**state['dist_args'])
-            #select snap position from distribution and fix them to one of 11 points
-            binned = -1.1 + np.digitize([dist.rvs()],bin_boundaries)*.2
-            context_sample = round(max(-1, min(1, binned[0])),2)
+            context_sample = float(contexts[trial])
 
             
             trial_list += [{
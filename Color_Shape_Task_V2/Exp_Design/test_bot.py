@@ -25,6 +25,10 @@ class test_bot:
                     self.__dict__[k]=self.taskinfo[k]
         #shadegenerators for each state
         self.state_dis = [dist(**state['dist_args']) for state in self.taskinfo['states'].values()] 
+        #likelihoods at the task's binned context values, computed once per bot
+        bins = np.unique(np.round(np.clip(-1.1 + .2*np.arange(12), -1, 1), 2))
+        bin_support = np.array([dis.pdf(bins) for dis in self.state_dis]).T
+        self.bin_support = dict(zip(bins, bin_support))
         self.TS_prior = [.5,.5]
         self.posterior = [.5, .5]
         self.mode = mode
@@ -41,7 +45,9 @@ class test_bot:
 
         
     def updateLikelihood(self, context):
-        support = [dis.pdf(context) for dis in self.state_dis]
+        support = self.bin_support.get(context)
+        if support is None:
+            support = [dis.pdf(context) for dis in self.state_dis]
         self.posterior = np.array([support[i]*self.TS_prior[i] for i in range(len(support))])/ \
                     np.sum([support[i]*self.TS_prior[i] for i in range(len(support))])
         if self.mode == "one-shot":
@@ -8,6 +8,60 @@ Created on Thu Feb 16 14:58:26 2017
 
 import numpy as np
 
+def genSeqs(n, p, n_seqs = 1, max_reps = 25, balance = .1, rng = None):
+    """
+    Vectorized sequence generator. Generates n_seqs binary sequences of length n
+    at once such that the values switch with probability 1-p, and a value is
+    never repeated more than max_reps+2 times in a row (a switch is forced once
+    state_reps > max_reps, as in genSeq). Sequences whose mean is further than
+    balance from .5 are masked out and more are drawn until n_seqs are kept.
+    :rng: numpy Generator/RandomState, or None for the global state
+    :return: int array (n_seqs, n)
+    """
+    if rng is None:
+        rng = np.random
+    max_run = max_reps + 2
+    seqs = np.empty((0, n), dtype = int)
+    while len(seqs) < n_seqs:
+        n_draw = 2*(n_seqs - len(seqs))
+        # run lengths are geometric, capped at max_run. n runs always cover n trials
+        if p < 1:
+            runs = np.minimum(rng.geometric(1-p, size = (n_draw, n)), max_run)
+        else:
+            runs = np.full((n_draw, n), max_run)
+        ends = np.cumsum(runs, 1)
+        switches = np.zeros((n_draw, n+1), dtype = int)
+        rows, cols = np.nonzero(ends < n)
+        switches[rows, ends[rows, cols]] = 1
+        start = rng.randint(0, 2, size = (n_draw, 1)) if hasattr(rng, 'randint') \
+            else rng.integers(0, 2, size = (n_draw, 1))
+        candidates = (start + np.cumsum(switches[:, :n], 1)) % 2
+        balanced = np.abs(candidates.mean(1) - .5) <= balance
+        seqs = np.vstack([seqs, candidates[balanced]])
+    return seqs[:n_seqs]
+
+def sampleContexts(states, dists, random_state = None):
+    """
+    Samples a context for every trial at once. For each state, all of its
+    contexts are drawn with one rvs call (in trial order), then fixed to the
+    center of one of the 11 bins between -1 and 1.
+    :states: array of states (any shape), used as keys into dists
+    :dists: dict (or list) of frozen scipy distributions, one per state
+    :random_state: seed, RandomState or Generator passed to rvs (default: global state)
+    :return: float array of binned contexts, same shape as states
+    """
+    bin_boundaries = np.linspace(-1,1,11)
+    states = np.asarray(states)
+    samples = np.empty(states.shape)
+    keys = dists.keys() if isinstance(dists, dict) else range(len(dists))
+    for key in sorted(keys):
+        index = states == key
+        if index.any():
+            samples[index] = dists[key].rvs(size = index.sum(), 
+                                            random_state = random_state)
+    binned = -1.1 + np.digitize(samples, bin_boundaries)*.2
+    return np.round(np.clip(binned, -1, 1), 2)
+
 def setBeta(seed = None, ab=None):
     """
     Sets a random beta distribution from a pre-defined catalog
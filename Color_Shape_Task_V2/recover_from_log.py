@@ -8,6 +8,10 @@ Created on Mon May 18 13:03:22 2015
 import numpy as np
 import yaml
 
+# libyaml's C loader and dumper when PyYAML was built with it
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+Dumper = getattr(yaml, 'CDumper', yaml.Dumper)
+
 config_file = 'Config_Files/Prob_Context_034_config_2015-05-17_14-20-37.npy'
 subject_code = '034'
 datafilename = subject_code + '_Prob_Context_2015-05-17_14-20-37'
@@ -31,9 +35,9 @@ run2 = run2[1:]
 run = run1 + run2
 
 
-trials = []
-for line in run:
-    trials.append(yaml.load(line[0:-1]))
+# each log line is one trial's json, which parses as yaml. Reading the lines as
+# one yaml list is much faster than a yaml.load call per line
+trials = yaml.load(''.join('- ' + line.rstrip('\n') + '\n' for line in run), Loader = Loader)
 
                
 
@@ -44,4 +48,4 @@ data['subcode']=subject_code
 data['timestamp']=timestamp
 data['taskdata']=trials
 f=open('RawData/' + datafilename + '.yaml','w')
-yaml.dump(data,f)
\ No newline at end of file
+yaml.dump(data,f,Dumper=Dumper)
\ No newline at end of file